@@ -17,9 +17,12 @@
              'data/document_type.xml',
              'data/partner.xml',
              'data/invoice_workflow.xml',
-             'data/res.currency.csv',
+             'data/parameter_sync_data.xml',
              'data/afip.journal_template.csv',
              'data/afip.concept_type.csv',
+             'data/invoice_job_data.xml',
+             'data/invoice_line_data.xml',
+             'data/caea_data.xml',
              'views/partner_view.xml',
              'views/country_view.xml',
              'views/afip_menuitem.xml',
@@ -36,6 +39,13 @@
              'views/afip_responsability_view.xml',
              'views/afip_responsability_class_view.xml',
              'views/afip_destination_view.xml',
+             'views/afip_invoice_job_view.xml',
+             'views/afip_partner_duplicate_view.xml',
+             'views/afip_numbering_audit_view.xml',
+             'views/afip_registry_view.xml',
+             'views/afip_refund_view.xml',
+             'views/afip_invoice_archive_view.xml',
+             'views/afip_caea_view.xml',
              'views/journal_view.xml',
              'views/invoice_view.xml',
              'views/invoice_config.xml',
@@ -51,7 +61,23 @@
              'data/com_ri2.yml'],
     'test': ['test/inv_ri2ri.yml',
              'test/inv_ri2rm.yml',
-             'test/bug_1042944.yml'],
+             'test/bug_1042944.yml',
+             'test/query_budget.yml',
+             'test/differential.yml',
+             'test/caea.yml',
+             'test/cache_bus.yml',
+             'test/supplier_duplicates.yml',
+             'test/tax_cache.yml',
+             'test/invoice_import.yml',
+             'test/invoice_archive.yml',
+             'test/journal_selection.yml',
+             'test/invoice_job.yml',
+             'test/numbering_audit.yml',
+             'test/afip_sync.yml',
+             'test/replica.yml',
+             'test/registry.yml',
+             'test/tax_status.yml',
+             'test/refund.yml'],
     'version': '8.0.5.1',
     'license': 'AGPL-3',
     'website': 'https://github.com/odoo-l10n-ar/l10n_ar_invoice',
@@ -1,11 +1,26 @@
 # -*- coding: utf-8 -*-
 
+import cache_bus
 import afip
+import tax_cache
 import invoice
+import invoice_archive
+import invoice_import
+import invoice_export
+import invoice_job
 import config
 import account
 import currency
 import country
 import partner
+import afip_sync
+import numbering_audit
+import report_cache
+import journal_selection
+import refund
+import indexes
+import registry
+import tax_status
+import caea
 
 # vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
-from openerp import api, models, _
+from openerp import api, models, tools, _
 from openerp import fields
 from openerp import exceptions
+from collections import OrderedDict
+from .cache_bus import versioned
 
 
 class afip_journal_template(models.Model):
@@ -32,6 +34,7 @@ class afip_document_class(models.Model):
 
 class afip_responsability(models.Model):
     _name = 'afip.responsability'
+    _inherit = 'afip.cached_model'
     _description = 'VAT Responsability'
 
     name = fields.Char('Name', size=64, required=True)
@@ -47,9 +50,13 @@ class afip_responsability(models.Model):
     _sql_constraints = [('name', 'unique(name)', 'Not repeat name!'),
                         ('code', 'unique(code)', 'Not repeat code!')]
 
+    # Relations are cached with the code of their responsabilities.
+    _afip_cached_models = ['afip.responsability_relation']
+
 
 class afip_responsability_relation(models.Model):
     _name = 'afip.responsability_relation'
+    _inherit = 'afip.cached_model'
     _description = 'Responsability relation'
 
     name = fields.Char('Name', size=64)
@@ -67,9 +74,49 @@ class afip_responsability_relation(models.Model):
          'Not configuration!'),
         ('name', 'unique(name)', 'Not repeat name!')]
 
+    @api.model
+    @versioned
+    @tools.ormcache(skiparg=1)
+    def _get_relation_index(self):
+        """
+        Issuer and receptor responsability codes by document class.
+        """
+        index = {}
+        for rel in self.search([]):
+            issuers, receptors = index.setdefault(rel.document_class_id.id,
+                                                  (set(), set()))
+            issuers.add(rel.issuer_id.code)
+            receptors.add(rel.receptor_id.code)
+        return index
+
+    @api.model
+    @versioned
+    @tools.ormcache(skiparg=1)
+    def _get_classes_by_responsabilities(self):
+        """
+        Document classes by issuer and receptor responsability ids.
+        """
+        res = {}
+        for rel in self.search_read([], ['issuer_id', 'receptor_id',
+                                          'document_class_id']):
+            res.setdefault((rel['issuer_id'][0], rel['receptor_id'][0]),
+                           set()).add(rel['document_class_id'][0])
+        return res
+
+    @api.model
+    def can_issue(self, document_class_id, code):
+        return code in self._get_relation_index().get(
+            document_class_id, ((), ()))[0]
+
+    @api.model
+    def can_receive(self, document_class_id, code):
+        return code in self._get_relation_index().get(
+            document_class_id, ((), ()))[1]
+
 
 class afip_journal_class(models.Model):
     _name = 'afip.journal_class'
+    _inherit = 'afip.cached_model'
     _description = 'AFIP Journal types'
 
     name = fields.Char('Name', size=64, required=True)
@@ -108,9 +155,42 @@ class afip_journal_class(models.Model):
 
     _sql_constraints = [('name', 'unique(name)', 'Not repeat name!')]
 
+    @api.model
+    @versioned
+    @tools.ormcache(skiparg=1)
+    def _get_class_table(self):
+        """
+        Data of active journal classes by id, in sequence order.
+        product_types is None when the class accepts any product.
+        """
+        res = OrderedDict()
+        for jc in self.search([], order='sequence, id'):
+            res[jc.id] = {
+                'type': jc.type,
+                'document_class_id': jc.document_class_id.id,
+                'afip_code': jc.afip_code,
+                'product_types': jc.product_types and frozenset(
+                    t.strip() for t in jc.product_types.split(',')) or None,
+            }
+        return res
+
+    @api.model
+    def accepts_products(self, journal_class_id, product_types):
+        """
+        True if products of these types can go in journals of the class.
+        Stockable products go where consumables do, and lines without
+        product are not checked.
+        """
+        jc = self._get_class_table().get(journal_class_id)
+        types = set('consu' if t == 'product' else t
+                    for t in product_types if t)
+        return not jc or jc['product_types'] is None or \
+            types <= jc['product_types']
+
 
 class afip_document_type(models.Model):
     _name = 'afip.document_type'
+    _inherit = 'afip.cached_model'
     _description = 'AFIP document types'
 
     name = fields.Char('Name', size=120, required=True)
@@ -118,9 +198,21 @@ class afip_document_type(models.Model):
     afip_code = fields.Integer('AFIP Code', required=True)
     active = fields.Boolean('Active', default=True)
 
+    @api.model
+    @versioned
+    @tools.ormcache(skiparg=1)
+    def _get_code_table(self):
+        """
+        AFIP code of document types by id, inactive ones included.
+        """
+        return dict((dt['id'], dt['afip_code']) for dt in
+                    self.with_context(active_test=False).search_read(
+                        [], ['afip_code']))
+
 
 class afip_concept_type(models.Model):
     _name = 'afip.concept_type'
+    _inherit = 'afip.cached_model'
     _description = 'AFIP concept types'
 
     name = fields.Char('Name', size=120, required=True)
@@ -133,6 +225,18 @@ class afip_concept_type(models.Model):
         ' separated by commas.',
         required=True)
 
+    @api.model
+    @versioned
+    @tools.ormcache(skiparg=1)
+    def _get_code_map(self):
+        """
+        Product types and AFIP code of active concepts.
+        """
+        return tuple((frozenset(s.strip()
+                                for s in concept.product_types.split(',')),
+                      str(concept.afip_code))
+                     for concept in self.search([]))
+
     @api.model
     def get_code(self, types):
         types = set(types)
@@ -141,12 +245,10 @@ class afip_concept_type(models.Model):
         if False in types:
             types.remove(False)
             types.add('undefined')
-        for concept in self.search([]):
-            product_types = set([s.strip()
-                                 for s in concept.product_types.split(',')])
+        for product_types, code in self._get_code_map():
             if product_types == types:
-                return str(concept.afip_code)
-	return False
+                return code
+        return False
 
     _sql_constraints = [('name', 'unique(name)', 'Not repeat name!')]
 
@@ -211,7 +313,8 @@ class afip_product_uom(models.Model):
     _inherit = 'product.uom'
 
     afip_uom_id = fields.Many2one('afip.uom', string='AFIP Unit')
-    afip_code = fields.Integer(compute='_get_afip_code', string='AFIP Code')
+    afip_code = fields.Integer(compute='_get_afip_code', string='AFIP Code',
+                               store=True)
 
     @api.depends('afip_uom_id.afip_code', 'category_id.afip_uom_id.afip_code')
     def _get_afip_code(self):
@@ -240,6 +343,7 @@ class afip_language(models.Model):
 
 class afip_destination(models.Model):
     _name = 'afip.destination'
+    _inherit = 'afip.cached_model'
 
     name = fields.Char('Name', required=True)
     afip_code = fields.Integer('Code', required=True)
@@ -254,6 +358,34 @@ class afip_destination(models.Model):
 
     _sql_constraints = [('name', 'unique(name)', 'Not repeat name!')]
 
+    @api.model
+    @versioned
+    @tools.ormcache(skiparg=1)
+    def _get_destination_index(self):
+        """
+        Return country and state to destination maps. Kept in the registry
+        cache until a destination is changed.
+        """
+        countries = {}
+        states = {}
+        for dest in self.search_read([], ['country_ids', 'state_ids'],
+                                     order='afip_code'):
+            for country_id in dest['country_ids']:
+                countries.setdefault(country_id, dest['id'])
+            for state_id in dest['state_ids']:
+                states.setdefault(state_id, dest['id'])
+        return {'countries': countries, 'states': states}
+
+    @api.model
+    def resolve(self, country_id, state_id=False):
+        """
+        Return the destination id for a country and state.
+        States take precedence over countries.
+        """
+        index = self._get_destination_index()
+        return index['states'].get(state_id) or \
+            index['countries'].get(country_id) or False
+
 
 class afip_incoterm(models.Model):
     _name = 'afip.incoterm'
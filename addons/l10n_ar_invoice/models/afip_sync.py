@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+from openerp import api, models, _
+from openerp.exceptions import Warning
+from openerp.modules.module import get_module_resource
+import csv
+import os
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+def _ws_date(value):
+    """
+    AFIP web services return dates as yyyymmdd and 'NULL' for no date.
+    """
+    if not value or value == 'NULL':
+        return False
+    value = str(value)
+    return '%s-%s-%s' % (value[:4], value[4:6], value[6:8])
+
+
+class afip_parameter_sync(models.AbstractModel):
+    """
+    Synchronize AFIP reference tables against parameter dumps.
+
+    Rows are diffed in memory against the current table, so only new or
+    changed records hit the database and equal updates are written in a
+    single batch. Dumps shipped with the module are synchronized on every
+    install and update.
+    """
+    _name = 'afip.parameter_sync'
+    _description = 'AFIP reference tables synchronization'
+
+    # Fields identifying a record of each synchronized model.
+    _sync_keys = {
+        'afip.document_type': ('afip_code',),
+        'afip.journal_class': ('code',),
+        'afip.responsability_relation': ('issuer_id', 'receptor_id',
+                                         'document_class_id'),
+        'afip.uom': ('afip_code',),
+        'afip.incoterm': ('afip_code',),
+        'afip.destination': ('afip_code',),
+        'res.currency': ('name',),
+    }
+
+    # Many2one values in dumps are given by code, not by database id.
+    _sync_refs = {
+        'afip.responsability_relation': {
+            'issuer_id': ('afip.responsability', 'code'),
+            'receptor_id': ('afip.responsability', 'code'),
+            'document_class_id': ('afip.document_class', 'name'),
+        },
+        'afip.journal_class': {
+            'document_class_id': ('afip.document_class', 'name'),
+        },
+    }
+
+    # Models where unknown records are only reported, never created.
+    _sync_update_only = ('res.currency',)
+
+    # Values of required fields missing in dumps, set on created records
+    # only.
+    _sync_create_defaults = {
+        'afip.document_type': lambda vals: {
+            'code': (vals.get('name') or str(vals['afip_code']))[:16]},
+    }
+
+    # Translation from web service parameter responses to model fields.
+    _ws_param_maps = {
+        'afip.document_type': {
+            'Doc_Id': ('afip_code', int),
+            'Doc_Ds': ('name', unicode),
+        },
+        'afip.uom': {
+            'Umed_Id': ('afip_code', int),
+            'Umed_Ds': ('name', unicode),
+            'Umed_vig_desde': ('valid_from', _ws_date),
+            'Umed_vig_hasta': ('valid_to', _ws_date),
+        },
+        'afip.incoterm': {
+            'Inc_Id': ('afip_code', unicode),
+            'Inc_Ds': ('name', unicode),
+        },
+        'afip.destination': {
+            'DST_CODIGO': ('afip_code', int),
+            'DST_Ds': ('name', unicode),
+        },
+        'res.currency': {
+            'Mon_Id': ('afip_code', unicode),
+            'Mon_Ds': ('afip_desc', unicode),
+            'Mon_vig_desde': ('afip_dt_from', _ws_date),
+        },
+    }
+
+    def _sync_cast(self, model, field_name, value):
+        """
+        Cast a value from a dump to what read() returns for this field.
+        """
+        field = model._fields[field_name]
+        if value in (None, '', 'NULL'):
+            return False
+        if field.type == 'integer':
+            return int(value)
+        if field.type == 'float':
+            return float(value)
+        if field.type == 'boolean':
+            return value in (True, 1, '1', 'True', 'true')
+        if field.type in ('char', 'text', 'selection') and \
+                isinstance(value, str):
+            return value.decode('utf-8')
+        return value
+
+    def _sync_resolver(self, model_name):
+        """
+        Return a function translating many2one codes into ids.
+        One query is done by referenced model.
+        """
+        refs = self._sync_refs.get(model_name, {})
+        maps = {}
+        for ref_model, ref_field in set(refs.values()):
+            maps[ref_model, ref_field] = dict(
+                (r[ref_field], r['id'])
+                for r in self.env[ref_model].with_context(
+                    active_test=False).search_read([], [ref_field]))
+
+        def resolve(field_name, value):
+            if field_name not in refs or not value:
+                return value
+            if isinstance(value, (int, long)):
+                return value
+            ref_model, ref_field = refs[field_name]
+            if value not in maps[ref_model, ref_field]:
+                raise Warning(_('Unknown %s %s in %s dump.') %
+                              (ref_model, value, model_name))
+            return maps[ref_model, ref_field][value]
+        return resolve
+
+    @api.model
+    def _sync_xml_id_keys(self, model, xml_id, keys):
+        """
+        Key values of the record with xml_id, ids without module being of
+        this module.
+        """
+        if '.' not in xml_id:
+            xml_id = 'l10n_ar_invoice.' + xml_id
+        record = self.env.ref(xml_id, raise_if_not_found=False)
+        if not record or record._name != model._name:
+            raise Warning(_('Unknown %s %s in %s dump.') %
+                          (model._name, xml_id, model._name))
+        values = record.read(list(keys), load='_classic_write')[0]
+        return dict((k, values[k]) for k in keys)
+
+    @api.model
+    def sync(self, model_name, rows, deactivate=False):
+        """
+        Apply the differences between rows and the current table.
+
+        rows is a list of dicts with field values. Rows without the key
+        fields are identified by their xml id, given in 'id'. Rows repeating
+        a key are rejected. Records of the table sharing a key are all
+        updated and counted as duplicated.
+
+        Returns a dict with the number of created, updated, deactivated,
+        unchanged, unknown and duplicated records.
+        """
+        if model_name not in self._sync_keys:
+            raise Warning(_('Model %s can not be synchronized.') % model_name)
+
+        model = self.env[model_name].with_context(active_test=False)
+        keys = self._sync_keys[model_name]
+        resolve = self._sync_resolver(model_name)
+
+        wanted = {}
+        repeated = []
+        for row in rows:
+            row = dict(row)
+            xml_id = row.pop('id', None)
+            vals = dict((f, resolve(f, self._sync_cast(model, f, v)))
+                        for f, v in row.items())
+            missing = [k for k in keys if k not in vals]
+            if missing and xml_id:
+                vals.update(self._sync_xml_id_keys(model, xml_id, missing))
+            elif missing:
+                raise Warning(_('Rows of %s dump lack %s, needed to identify'
+                                ' records.') %
+                              (model_name, ', '.join(missing)))
+            key = tuple(vals[k] for k in keys)
+            if key in wanted:
+                repeated.append(key)
+            wanted[key] = vals
+        if repeated:
+            raise Warning(_('Rows of %s dump repeat %s: %s.') % (
+                model_name, ', '.join(keys),
+                '; '.join(', '.join(unicode(v) for v in key)
+                          for key in sorted(set(repeated)))))
+
+        field_names = set(keys)
+        for vals in wanted.values():
+            field_names.update(vals)
+        if 'active' in model._fields:
+            field_names.add('active')
+
+        current = {}
+        for rec in model.search([]).read(list(field_names),
+                                         load='_classic_write'):
+            current.setdefault(tuple(rec[k] for k in keys), []).append(rec)
+
+        to_create = []
+        to_write = {}
+        stats = {'created': 0, 'updated': 0, 'deactivated': 0,
+                 'unchanged': 0, 'unknown': 0, 'duplicated': 0}
+        duplicated = [key for key, recs in current.items() if len(recs) > 1]
+        if duplicated:
+            stats['duplicated'] = sum(len(current[key]) - 1
+                                      for key in duplicated)
+            _logger.warning('Records of %s repeat %s: %s' % (
+                model_name, ', '.join(keys), duplicated))
+
+        for key, vals in wanted.items():
+            recs = current.pop(key, None)
+            if recs is None:
+                if model_name in self._sync_update_only:
+                    stats['unknown'] += 1
+                else:
+                    to_create.append(vals)
+                continue
+            for rec in recs:
+                changes = dict((f, v) for f, v in vals.items()
+                               if rec[f] != v)
+                if 'active' in rec and not rec['active'] and \
+                        'active' not in vals:
+                    changes['active'] = True
+                if changes:
+                    to_write.setdefault(tuple(sorted(changes.items())),
+                                        []).append(rec['id'])
+                else:
+                    stats['unchanged'] += 1
+
+        # Records with the same changes are written together.
+        for changes, ids in to_write.items():
+            model.browse(ids).write(dict(changes))
+            stats['updated'] += len(ids)
+
+        defaults = self._sync_create_defaults.get(model_name)
+        for vals in to_create:
+            if defaults:
+                vals = dict(defaults(vals), **vals)
+            model.create(vals)
+            stats['created'] += 1
+
+        if deactivate and 'active' in model._fields:
+            ids = [rec['id'] for recs in current.values() for rec in recs
+                   if rec['active']]
+            if ids:
+                model.browse(ids).write({'active': False})
+            stats['deactivated'] = len(ids)
+
+        _logger.info('Synchronized %s: %s' % (model_name, stats))
+        return stats
+
+    @api.model
+    def sync_ws_response(self, model_name, items, deactivate=False):
+        """
+        Synchronize from the items of a web service parameter response,
+        given as a list of dicts.
+        """
+        if model_name not in self._ws_param_maps:
+            raise Warning(_('No web service parameter map for %s.') %
+                          model_name)
+        field_map = self._ws_param_maps[model_name]
+        rows = []
+        for item in items:
+            row = {}
+            for ws_key, value in item.items():
+                if ws_key in field_map:
+                    field_name, cast = field_map[ws_key]
+                    row[field_name] = cast(value) if value is not None \
+                        else False
+            rows.append(row)
+        unknown = []
+        if model_name == 'res.currency':
+            rows, unknown = self._currency_rows(rows)
+        stats = self.sync(model_name, rows, deactivate=deactivate)
+        if unknown:
+            _logger.warning('Unknown AFIP currency codes: %s' %
+                            ', '.join(unknown))
+            stats['unknown'] += len(unknown)
+        return stats
+
+    @api.model
+    def _currency_rows(self, rows):
+        """
+        AFIP identifies currencies by its own code. Map them to currency
+        names through the codes already known. Return the rows mapped and
+        the codes not known.
+        """
+        by_code = dict(
+            (c['afip_code'], c['name'])
+            for c in self.env['res.currency'].with_context(
+                active_test=False).search_read(
+                    [('afip_code', '!=', False)], ['afip_code', 'name']))
+        res = []
+        unknown = []
+        for row in rows:
+            if row.get('afip_code') in by_code:
+                row['name'] = by_code[row['afip_code']]
+                res.append(row)
+            else:
+                unknown.append(row.get('afip_code') or '')
+        return res, unknown
+
+    @api.model
+    def sync_file(self, model_name, path, deactivate=False):
+        """
+        Synchronize from a CSV file with field names as header.
+        """
+        with open(path, 'rb') as f:
+            rows = list(csv.DictReader(f))
+        return self.sync(model_name, rows, deactivate=deactivate)
+
+    @api.model
+    def sync_directory(self, path, deactivate=False):
+        """
+        Synchronize every <model name>.csv file found in path.
+        """
+        res = {}
+        for model_name in sorted(self._sync_keys):
+            filename = os.path.join(path, '%s.csv' % model_name)
+            if os.path.exists(filename):
+                res[model_name] = self.sync_file(model_name, filename,
+                                                 deactivate=deactivate)
+        return res
+
+    @api.model
+    def sync_module_files(self, files):
+        """
+        Synchronize dumps of this module, given as (model name, path in
+        the module) pairs. Called on install and update by
+        data/parameter_sync_data.xml.
+        """
+        res = {}
+        for model_name, path in files:
+            res[model_name] = self.sync_file(
+                model_name,
+                get_module_resource('l10n_ar_invoice', *path.split('/')))
+        return res
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
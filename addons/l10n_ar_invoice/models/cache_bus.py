@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Keep the reference data caches of every worker process coherent.
+
+Each cached model has a version counter in afip_cache_version, raised once
+the transaction changing the model is committed. Cached lookups check the
+counters once by transaction, one query, and drop the cache entries of the
+models whose version changed since this process last read it. Other models
+keep their entries, unlike with clear_caches which clears the whole registry
+cache of every worker.
+"""
+from openerp import api, models
+import functools
+import weakref
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Models whose cache entries follow their version.
+CACHED_MODELS = (
+    'afip.responsability_relation',
+    'afip.journal_class',
+    'afip.concept_type',
+    'afip.document_type',
+    'afip.destination',
+    'afip.caea',
+    'res.currency',
+)
+
+# Versions last read by this process, by database.
+_seen = {}
+
+# Cursors whose versions were already checked in the current transaction.
+_checked = weakref.WeakKeyDictionary()
+
+# Models changed in the current transaction of each cursor.
+_pending = weakref.WeakKeyDictionary()
+
+
+def _clear_local(registry, model_names):
+    """
+    Drop the cache entries of model_names in this process only.
+    """
+    cache = registry.cache
+    for key in cache.keys():
+        if key[0] in model_names:
+            try:
+                del cache[key]
+            except KeyError:
+                pass
+
+
+def _raise_versions(registry, model_names):
+    """
+    Raise the version of model_names in a transaction of its own, so the
+    rows of afip_cache_version are only locked while doing it.
+    """
+    if not model_names:
+        return
+    try:
+        with registry.cursor() as cr:
+            cr.execute("""
+                UPDATE afip_cache_version SET version = version + 1
+                WHERE model IN %s
+            """, (tuple(model_names),))
+    except Exception:
+        _logger.exception('Could not raise cache versions of %s' %
+                          ', '.join(model_names))
+
+
+def bump_versions(env, model_names):
+    """
+    Raise the version of model_names once the transaction is committed, so
+    other processes drop their cache entries. This process drops them again
+    on its next check, in case the transaction is rolled back.
+    """
+    cr = env.cr
+    if cr not in _pending:
+        registry = env.registry
+        _pending[cr] = set()
+        cr.after('commit', lambda: _raise_versions(
+            registry, sorted(_pending.pop(cr, ()))))
+        cr.after('rollback', lambda: _pending.pop(cr, None))
+    _pending[cr].update(model_names)
+    _clear_local(env.registry, model_names)
+    seen = _seen.setdefault(env.cr.dbname, {})
+    for name in model_names:
+        seen[name] = None
+
+
+def check_versions(env):
+    """
+    Drop cache entries of models changed by other processes. Only the first
+    call of a transaction reads the versions.
+    """
+    cr = env.cr
+    if cr in _checked:
+        return
+    cr.execute("SELECT model, version FROM afip_cache_version")
+    versions = dict(cr.fetchall())
+    seen = _seen.setdefault(cr.dbname, {})
+    changed = [name for name, version in versions.items()
+               if name in seen and seen[name] != version]
+    if changed:
+        _logger.debug('Dropping caches of %s' % ', '.join(changed))
+        _clear_local(env.registry, changed)
+    seen.update(versions)
+    _checked[cr] = True
+    forget = lambda: _checked.pop(cr, None)
+    cr.after('commit', forget)
+    cr.after('rollback', forget)
+
+
+def versioned(method):
+    """
+    Decorate an ormcache lookup to check versions before using the cache.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        check_versions(self.env)
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+class afip_cached_model(models.AbstractModel):
+    """
+    Raise the cache versions on every change of the records.
+
+    _afip_cached_models are the cached models depending on the records, the
+    model itself by default. When _afip_cached_fields is set, creating or
+    writing records only raises the versions if one of them is given.
+    """
+    _name = 'afip.cached_model'
+    _description = 'AFIP cached model'
+
+    _afip_cached_models = None
+    _afip_cached_fields = None
+
+    @api.model
+    def _afip_bump_versions(self, vals=None):
+        fields = self._afip_cached_fields
+        if vals is None or fields is None or set(fields) & set(vals):
+            bump_versions(self.env, self._afip_cached_models or [self._name])
+
+    @api.model
+    def create(self, vals):
+        self._afip_bump_versions(vals)
+        return super(afip_cached_model, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        self._afip_bump_versions(vals)
+        return super(afip_cached_model, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self._afip_bump_versions()
+        return super(afip_cached_model, self).unlink()
+
+
+class afip_cache_version(models.AbstractModel):
+    """
+    Create the version counters of the cached models.
+    """
+    _name = 'afip.cache_version'
+    _description = 'AFIP cache versions'
+
+    def init(self, cr):
+        cr.execute("""
+            CREATE TABLE IF NOT EXISTS afip_cache_version (
+                model varchar PRIMARY KEY,
+                version integer NOT NULL DEFAULT 0)
+        """)
+        cr.execute("""
+            INSERT INTO afip_cache_version (model)
+            SELECT name FROM unnest(%s::varchar[]) AS name
+            WHERE name NOT IN (SELECT model FROM afip_cache_version)
+        """, (list(CACHED_MODELS),))
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
@@ -0,0 +1,461 @@
+# -*- coding: utf-8 -*-
+from openerp import api, models, fields, tools, _
+from openerp.exceptions import Warning
+from datetime import timedelta
+from .chunked import iter_chunks
+from .cache_bus import versioned
+import hashlib
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Vouchers accepted by AFIP in one report request.
+_report_batch_size = 250
+
+# Days after the end of a fortnight to report its vouchers.
+_report_days = 8
+
+
+def _fortnight(date):
+    """
+    Period (yyyymm), fortnight and first and last dates of the CAEA
+    fortnight holding date.
+    """
+    day = fields.Date.from_string(date)
+    if day.day <= 15:
+        start, stop, order = day.replace(day=1), day.replace(day=15), '1'
+    else:
+        start = day.replace(day=16)
+        stop = day.replace(day=28) + timedelta(days=4)
+        stop -= timedelta(days=stop.day)
+        order = '2'
+    return (day.strftime('%Y%m'), order, fields.Date.to_string(start),
+            fields.Date.to_string(stop))
+
+
+class afip_caea_service_local(models.AbstractModel):
+    """
+    Local stand-in of the AFIP anticipated authorization service.
+
+    Codes are derived from the company CUIT and the fortnight, and reports
+    are checked against them, so CAEA issuing can be tried without network.
+    A service is any model with the methods of this one, selected by the
+    l10n_ar_invoice.caea_service parameter.
+    """
+    _name = 'afip.caea_service_local'
+    _description = 'AFIP CAEA local service'
+
+    @api.model
+    def _code(self, company, period, order):
+        cuit = company.partner_id.document_number_normalized or ''
+        digest = hashlib.md5('%s:%s:%s' % (cuit, period, order)).hexdigest()
+        return '%014i' % (int(digest, 16) % 10 ** 14)
+
+    @api.model
+    def request_caea(self, company, period, order):
+        """
+        CAEA of company for a fortnight, as a dict with code, date_from,
+        date_to and date_report_due.
+        """
+        date_from = '%s-%s-%s' % (period[:4], period[4:],
+                                  '01' if order == '1' else '16')
+        dummy, dummy, date_from, date_to = _fortnight(date_from)
+        due = fields.Date.from_string(date_to) + timedelta(days=_report_days)
+        return {
+            'code': self._code(company, period, order),
+            'date_from': date_from,
+            'date_to': date_to,
+            'date_report_due': fields.Date.to_string(due),
+        }
+
+    @api.model
+    def report_vouchers(self, company, code, point_of_sale, class_code,
+                        vouchers):
+        """
+        Report vouchers issued with CAEA code. Return error messages by
+        voucher number of the rejected ones.
+        """
+        rejected = {}
+        for voucher in vouchers:
+            date = voucher['CbteFch']
+            period, order, dummy, dummy = _fortnight(
+                '%s-%s-%s' % (date[:4], date[4:6], date[6:]))
+            if voucher['CAEA'] != code or \
+                    code != self._code(company, period, order):
+                rejected[voucher['CbteDesde']] = _(
+                    'CAEA does not belong to the voucher fortnight.')
+            elif not voucher['CbteDesde']:
+                rejected[voucher['CbteDesde']] = _('Voucher without number.')
+            elif voucher['DocTipo'] != 99 and not voucher['DocNro']:
+                rejected[voucher['CbteDesde']] = _(
+                    'Receptor without document number.')
+        return rejected
+
+    @api.model
+    def report_no_movement(self, company, code, point_of_sale):
+        """
+        Report point_of_sale issued nothing with CAEA code. Return an error
+        message or None.
+        """
+        return None
+
+
+class afip_caea(models.Model):
+    """
+    Anticipated authorization code of a company for a fortnight.
+
+    Codes are requested before the fortnight begins, assigned to vouchers
+    at confirmation without calling AFIP, and the vouchers are reported
+    afterwards in batches by point of sale.
+    """
+    _name = 'afip.caea'
+    _inherit = 'afip.cached_model'
+    _description = 'AFIP anticipated authorization code'
+    _order = 'date_from desc, company_id'
+    _rec_name = 'code'
+
+    company_id = fields.Many2one('res.company', 'Company', required=True,
+                                 readonly=True)
+    code = fields.Char('CAEA', size=14, required=True, readonly=True)
+    period = fields.Char('Period', size=6, required=True, readonly=True)
+    fortnight = fields.Selection([('1', 'First'), ('2', 'Second')],
+                                 'Fortnight', required=True, readonly=True)
+    date_from = fields.Date('From', required=True, readonly=True)
+    date_to = fields.Date('To', required=True, readonly=True)
+    date_report_due = fields.Date('Report due', readonly=True)
+    state = fields.Selection([('open', 'In use'), ('reported', 'Reported')],
+                             'State', default='open', readonly=True)
+    report_ids = fields.One2many('afip.caea_report', 'caea_id', 'Reports',
+                                 readonly=True)
+    pending_count = fields.Integer('Vouchers to report',
+                                   compute='_get_voucher_counts')
+    rejected_count = fields.Integer('Rejected vouchers',
+                                    compute='_get_voucher_counts')
+
+    _sql_constraints = [
+        ('fortnight_uniq', 'unique(company_id, period, fortnight)',
+         'There is already a CAEA for this fortnight.'),
+    ]
+
+    @api.multi
+    def _get_voucher_counts(self):
+        counts = dict(((caea_id, state), count) for caea_id, state, count in
+                      self._voucher_counts())
+        for caea in self:
+            caea.pending_count = counts.get((caea.id, 'pending'), 0)
+            caea.rejected_count = counts.get((caea.id, 'rejected'), 0)
+
+    @api.multi
+    def _voucher_counts(self):
+        if not self.ids:
+            return []
+        self.env.cr.execute("""
+            SELECT afip_caea_id, afip_caea_state, count(*)
+            FROM account_invoice
+            WHERE afip_caea_id IN %s
+              AND afip_caea_state IN ('pending', 'rejected')
+            GROUP BY afip_caea_id, afip_caea_state
+        """, (tuple(self.ids),))
+        return self.env.cr.fetchall()
+
+    @api.model
+    def _service_name(self):
+        name = self.env['ir.config_parameter'].get_param(
+            'l10n_ar_invoice.caea_service')
+        return name if name in self.env.registry else False
+
+    @api.model
+    def _service(self):
+        name = self._service_name()
+        if not name:
+            raise Warning(_('No CAEA service\n'
+                            'Set the l10n_ar_invoice.caea_service parameter'
+                            ' to the model of the CAEA service.'))
+        return self.env[name]
+
+    @api.model
+    @versioned
+    @tools.ormcache(skiparg=1)
+    def _get_code_table(self):
+        """
+        (date_from, date_to, id, code) of CAEAs by company.
+        """
+        res = {}
+        for caea in self.search_read([], ['company_id', 'date_from',
+                                          'date_to', 'code']):
+            res.setdefault(caea['company_id'][0], []).append(
+                (caea['date_from'], caea['date_to'], caea['id'],
+                 caea['code']))
+        return res
+
+    @api.model
+    def _find(self, company_id, date):
+        """
+        (id, code, date_to) of the CAEA of company for date, or None.
+        """
+        for date_from, date_to, caea_id, code in \
+                self._get_code_table().get(company_id, ()):
+            if date_from <= date <= date_to:
+                return caea_id, code, date_to
+        return None
+
+    @api.model
+    def request_for_date(self, company_id, date):
+        """
+        CAEA of company for the fortnight holding date, requested to the
+        service when there is none.
+        """
+        period, order, dummy, dummy = _fortnight(date)
+        caea = self.search([('company_id', '=', company_id),
+                            ('period', '=', period),
+                            ('fortnight', '=', order)])
+        if caea:
+            return caea
+        company = self.env['res.company'].browse(company_id)
+        vals = self._service().request_caea(company, period, order)
+        vals.update(company_id=company_id, period=period, fortnight=order)
+        _logger.info('Got CAEA %s of %s for %s/%s' % (
+            vals['code'], company.name, period, order))
+        return self.create(vals)
+
+    @api.model
+    def _caea_companies(self):
+        return self.env['account.journal'].search(
+            [('afip_caea', '=', True)]).mapped('company_id')
+
+    @api.model
+    def cron_request(self, days_ahead=5):
+        """
+        Request the CAEAs of the current fortnight and of the one starting
+        within days_ahead for every company with CAEA journals.
+        """
+        today = fields.Date.context_today(self)
+        ahead = fields.Date.to_string(
+            fields.Date.from_string(today) + timedelta(days=days_ahead))
+        caeas = self.browse()
+        for company in self._caea_companies():
+            for date in (today, ahead):
+                caeas |= self.request_for_date(company.id, date)
+        return caeas
+
+    @api.model
+    def action_request(self):
+        caeas = self.cron_request()
+        return {
+            'type': 'ir.actions.act_window',
+            'name': _('CAEA'),
+            'res_model': self._name,
+            'view_type': 'form',
+            'view_mode': 'tree,form',
+            'domain': [('id', 'in', caeas.ids)],
+        }
+
+    @api.model
+    def cron_report(self, batch_size=_report_batch_size):
+        """
+        Report pending vouchers of every CAEA in use, committing after each
+        batch. Does nothing on databases without CAEA journals or service.
+        """
+        if not self._caea_companies():
+            return
+        if not self._service_name():
+            _logger.warning('CAEA journals found but no CAEA service set,'
+                            ' vouchers not reported.')
+            return
+        self.search([('state', '=', 'open')]).report_pending(
+            batch_size=batch_size, commit=True)
+
+    @api.multi
+    def report_pending(self, batch_size=_report_batch_size, commit=False):
+        """
+        Report vouchers waiting for it, batch_size vouchers of a journal by
+        request. Points of sale without vouchers are reported once the
+        fortnight is over.
+        """
+        if not self:
+            return True
+        service = self._service()
+        invoice_obj = self.env['account.invoice']
+        today = fields.Date.context_today(self)
+        for caea in self:
+            self.env.cr.execute("""
+                SELECT journal_id, array_agg(id ORDER BY afip_doc_number)
+                FROM account_invoice
+                WHERE afip_caea_id = %s AND afip_caea_state = 'pending'
+                GROUP BY journal_id
+                ORDER BY journal_id
+            """, (caea.id,))
+            for journal_id, ids in self.env.cr.fetchall():
+                journal = self.env['account.journal'].browse(journal_id)
+                for chunk in iter_chunks(invoice_obj.browse(ids), batch_size,
+                                         commit=commit):
+                    caea._report_batch(service, journal, chunk)
+
+            if caea.date_to < today:
+                caea._report_no_movement(service)
+                if not caea._voucher_counts():
+                    caea.state = 'reported'
+            if commit:
+                self.env.cr.commit()
+        return True
+
+    @api.multi
+    def _report_batch(self, service, journal, invoices):
+        """
+        Report invoices of journal and keep the result.
+        """
+        self.ensure_one()
+        vouchers = [inv._afip_caea_voucher() for inv in invoices]
+        rejected = service.report_vouchers(
+            self.company_id, self.code, journal.point_of_sale,
+            journal.journal_class_id.afip_code, vouchers)
+        rejected_invoices = invoices.filtered(
+            lambda inv: inv.afip_doc_number in rejected)
+        (invoices - rejected_invoices).write({'afip_caea_state': 'reported'})
+        rejected_invoices.write({'afip_caea_state': 'rejected'})
+
+        numbers = [v['CbteDesde'] for v in vouchers]
+        self.env['afip.caea_report'].create({
+            'caea_id': self.id,
+            'journal_id': journal.id,
+            'point_of_sale': journal.point_of_sale,
+            'number_from': min(numbers),
+            'number_to': max(numbers),
+            'voucher_count': len(vouchers),
+            'rejected_count': len(rejected_invoices),
+            'message': '\n'.join('%s: %s' % (n, rejected[n])
+                                 for n in sorted(rejected)) or False,
+            'date': fields.Datetime.now(),
+        })
+        _logger.info('Reported %i vouchers of %s with CAEA %s, %i rejected' %
+                     (len(vouchers), journal.name, self.code,
+                      len(rejected_invoices)))
+
+    @api.multi
+    def _report_no_movement(self, service):
+        """
+        Report points of sale of CAEA journals without reports.
+        """
+        self.ensure_one()
+        reported = set(self.report_ids.mapped('point_of_sale'))
+        journals = self.env['account.journal'].search(
+            [('afip_caea', '=', True),
+             ('company_id', '=', self.company_id.id)])
+        for pos in sorted(set(journals.mapped('point_of_sale')) - reported):
+            message = service.report_no_movement(self.company_id, self.code,
+                                                 pos)
+            self.env['afip.caea_report'].create({
+                'caea_id': self.id,
+                'point_of_sale': pos,
+                'voucher_count': 0,
+                'message': message or False,
+                'date': fields.Datetime.now(),
+            })
+
+    @api.multi
+    def action_report(self):
+        return self.report_pending()
+
+    @api.multi
+    def action_retry_rejected(self):
+        """
+        Report rejected vouchers again, once corrected.
+        """
+        invoices = self.env['account.invoice'].search(
+            [('afip_caea_id', 'in', self.ids),
+             ('afip_caea_state', '=', 'rejected')])
+        invoices.write({'afip_caea_state': 'pending'})
+        self.write({'state': 'open'})
+        return True
+
+
+class afip_caea_report(models.Model):
+    """
+    Vouchers of a point of sale reported under a CAEA in one request.
+    """
+    _name = 'afip.caea_report'
+    _description = 'AFIP CAEA report'
+    _order = 'date desc, id desc'
+
+    caea_id = fields.Many2one('afip.caea', 'CAEA', required=True,
+                              ondelete='cascade', select=True)
+    journal_id = fields.Many2one('account.journal', 'Journal')
+    point_of_sale = fields.Integer('Point of sale')
+    number_from = fields.Integer('From number')
+    number_to = fields.Integer('To number')
+    voucher_count = fields.Integer('Vouchers')
+    rejected_count = fields.Integer('Rejected')
+    message = fields.Text('Message')
+    date = fields.Datetime('Date')
+
+
+class account_journal(models.Model):
+    _inherit = 'account.journal'
+
+    afip_caea = fields.Boolean(
+        'Anticipated authorization (CAEA)',
+        help="Vouchers get the CAEA of their fortnight at confirmation and"
+        " are reported to AFIP later.")
+
+
+class account_invoice(models.Model):
+    _inherit = 'account.invoice'
+
+    afip_caea_id = fields.Many2one('afip.caea', 'CAEA', readonly=True,
+                                   copy=False, ondelete='restrict')
+    afip_caea_state = fields.Selection(
+        [('pending', 'To report'), ('reported', 'Reported'),
+         ('rejected', 'Rejected')], 'CAEA report', readonly=True,
+        copy=False)
+
+    @api.multi
+    def afip_assign_caea(self):
+        """
+        Set the CAEA of their fortnight to invoices of CAEA journals, with
+        no call to AFIP. Called by the open activity.
+        """
+        caea_obj = self.env['afip.caea']
+        to_write = {}
+        for inv in self:
+            if not inv.journal_id.afip_caea or inv.afip_cae:
+                continue
+            caea = caea_obj._find(inv.company_id.id, inv.date_invoice)
+            if caea is None:
+                raise Warning(
+                    _('No CAEA\n'
+                      'There is no CAEA of %s for %s. It must be requested'
+                      ' before the fortnight begins.') %
+                    (inv.company_id.name, inv.date_invoice))
+            to_write.setdefault(caea, []).append(inv.id)
+
+        for (caea_id, code, date_to), ids in to_write.items():
+            self.browse(ids).write({'afip_caea_id': caea_id,
+                                    'afip_cae': code,
+                                    'afip_cae_due': date_to,
+                                    'afip_caea_state': 'pending'})
+        return True
+
+    @api.multi
+    def _afip_caea_voucher(self):
+        """
+        Voucher of the CAEA report request.
+        """
+        self.ensure_one()
+        partner = self.partner_id
+        return {
+            'Concepto': int(self.afip_concept or 1),
+            'DocTipo': self.env['afip.document_type']._get_code_table().get(
+                partner.document_type_id.id) or 99,
+            'DocNro': int(partner.document_number_normalized or 0),
+            'CbteDesde': self.afip_doc_number,
+            'CbteHasta': self.afip_doc_number,
+            'CbteFch': self.date_invoice.replace('-', ''),
+            'ImpTotal': self.amount_total,
+            'ImpNeto': self.amount_untaxed,
+            'ImpIVA': self.amount_tax,
+            'MonId': self.env['res.currency']._get_afip_code_map().get(
+                self.currency_id.id) or 'PES',
+            'CAEA': self.afip_cae,
+        }
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Run batch operations over large recordsets by chunks of ids, so the
+environment cache only ever holds one chunk.
+"""
+import logging
+import time
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def iter_chunks(records, chunk_size=DEFAULT_CHUNK_SIZE, commit=False,
+                checkpoint=None, progress=None, label=None):
+    """
+    Yield records by chunks of chunk_size ids.
+
+    After each chunk pending computations are flushed and the cache of
+    the environment is cleared. With commit, the transaction is committed
+    after each chunk. checkpoint is called with the last id of each chunk
+    done, and progress with the number of records done and the total.
+    Progress is also logged when label is given.
+
+    A recordset fitting in one chunk is yielded as is and the cache kept.
+    """
+    ids = records.ids
+    total = len(ids)
+    if total <= chunk_size and not commit:
+        yield records
+        if progress:
+            progress(total, total)
+        return
+
+    env = records.env
+    start = time.time()
+    for i in xrange(0, total, chunk_size):
+        chunk_ids = ids[i:i + chunk_size]
+        yield records.browse(chunk_ids)
+        records.recompute()
+        if commit:
+            env.cr.commit()
+        if checkpoint:
+            checkpoint(chunk_ids[-1])
+        env.invalidate_all()
+
+        done = i + len(chunk_ids)
+        if progress:
+            progress(done, total)
+        if label:
+            _logger.info('%s: %i of %i (%.0f%%) in %.1fs' % (
+                label, done, total, 100.0 * done / total,
+                time.time() - start))
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
@@ -2,9 +2,12 @@
 from openerp import fields, models
 
 class afip_country(models.Model):
-    _inherit = 'res.country'
+    _inherit = ['res.country', 'afip.cached_model']
 
     afip_destination_ids=fields.Many2many('afip.destination',
                                           string='AFIP destinations')
 
+    _afip_cached_models = ['afip.destination']
+    _afip_cached_fields = ['afip_destination_ids']
+
 # vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
+from openerp import api, models, tools
 from openerp.osv import fields, osv
+from .cache_bus import versioned
 
 
 class res_currency(osv.osv):
@@ -15,4 +17,21 @@ class res_currency(osv.osv):
 
 res_currency()
 
+
+class afip_currency(models.Model):
+    _inherit = ['res.currency', 'afip.cached_model']
+
+    _afip_cached_fields = ['afip_code']
+
+    @api.model
+    @versioned
+    @tools.ormcache(skiparg=1)
+    def _get_afip_code_map(self):
+        """
+        AFIP code of currencies by id, inactive ones included.
+        """
+        return dict((c['id'], c['afip_code']) for c in
+                    self.with_context(active_test=False).search_read(
+                        [('afip_code', '!=', False)], ['afip_code']))
+
 # vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
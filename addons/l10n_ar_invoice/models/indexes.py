@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from openerp import models
+import hashlib
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Indexes used by AFIP lookups, as (name, table, columns, where).
+AFIP_INDEXES = [
+    ('account_journal_afip_journal_class',
+     'account_journal', 'journal_class_id', None),
+    ('account_journal_afip_point_of_sale',
+     'account_journal', 'company_id, point_of_sale',
+     'journal_class_id IS NOT NULL'),
+    ('afip_responsability_relation_issuer',
+     'afip_responsability_relation', 'document_class_id, issuer_id', None),
+    ('afip_responsability_relation_receptor',
+     'afip_responsability_relation', 'document_class_id, receptor_id', None),
+    # Prefix searches (=like 'digits%') under a non C collation.
+    ('res_partner_afip_document_prefix',
+     'res_partner', 'document_number_normalized varchar_pattern_ops', None),
+    ('res_partner_afip_responsability',
+     'res_partner', 'responsability_id, document_type_id', None),
+    ('account_invoice_afip_doc_number',
+     'account_invoice', 'journal_id, afip_doc_number',
+     "afip_doc_number > 0 AND state NOT IN ('draft', 'cancel')"),
+    ('account_invoice_afip_supplier_voucher',
+     'account_invoice',
+     'afip_partner_document, afip_journal_class_code, afip_supplier_pos,'
+     ' afip_supplier_number',
+     "type IN ('in_invoice', 'in_refund') AND state != 'cancel'"),
+    ('account_invoice_afip_export',
+     'account_invoice', 'company_id, date_invoice',
+     "afip_journal_class_code IN (19, 20, 21)"
+     " AND state NOT IN ('draft', 'cancel')"),
+    ('account_invoice_afip_caea_pending',
+     'account_invoice', 'afip_caea_id, journal_id, afip_doc_number',
+     "afip_caea_state IN ('pending', 'rejected')"),
+]
+
+# Comment marking indexes of this module, followed by a definition hash.
+_mark = 'l10n_ar_invoice:'
+
+
+def _definition(table, columns, where):
+    return 'ON %s (%s)%s' % (table, columns,
+                             where and ' WHERE %s' % where or '')
+
+
+def ensure_indexes(cr, indexes=AFIP_INDEXES):
+    """
+    Create missing indexes, rebuild the ones whose definition changed and
+    drop the ones no longer defined.
+    """
+    cr.execute("""
+        SELECT c.relname, obj_description(c.oid, 'pg_class')
+        FROM pg_class AS c
+        WHERE c.relkind = 'i'
+          AND obj_description(c.oid, 'pg_class') LIKE %s
+    """, (_mark + '%',))
+    existing = dict(cr.fetchall())
+
+    for name, table, columns, where in indexes:
+        definition = _definition(table, columns, where)
+        comment = _mark + hashlib.md5(definition).hexdigest()
+        if existing.pop(name, None) == comment:
+            continue
+        _logger.info('Building index %s' % name)
+        cr.execute('DROP INDEX IF EXISTS "%s"' % name)
+        cr.execute('CREATE INDEX "%s" %s' % (name, definition))
+        cr.execute('COMMENT ON INDEX "%s" IS %%s' % name, (comment,))
+
+    for name in existing:
+        _logger.info('Dropping index %s' % name)
+        cr.execute('DROP INDEX IF EXISTS "%s"' % name)
+
+
+def drop_indexes(cr, indexes=AFIP_INDEXES):
+    for name, table, columns, where in indexes:
+        cr.execute('DROP INDEX IF EXISTS "%s"' % name)
+
+
+class afip_index_pack(models.AbstractModel):
+    """
+    Keep AFIP indexes up to date on install and update. Loaded after the
+    models defining the indexed columns.
+    """
+    _name = 'afip.index_pack'
+    _description = 'AFIP database indexes'
+
+    def init(self, cr):
+        ensure_indexes(cr)
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
@@ -3,6 +3,9 @@ from openerp import api, models, fields, _
 from datetime import date
 from dateutil.relativedelta import relativedelta
 from openerp.exceptions import Warning
+from .tax_cache import get_tax_memo
+from .partner import normalize_document
+from .chunked import iter_chunks, DEFAULT_CHUNK_SIZE
 import re
 import logging
 
@@ -11,6 +14,36 @@ _logger = logging.getLogger(__name__)
 # Label filter to recover invoice number
 re_label = re.compile(r'%\([^\)]+\)s')
 
+# Point of sale and number of a supplier voucher, as 0001-00001234
+re_supplier_number = re.compile(r'(?:(\d+)\D+)?(\d+)\D*$')
+
+
+# Compiled document number expressions by sequence prefix and suffix
+_doc_number_res = {}
+
+
+def _doc_number_re(prefix, suffix):
+    """
+    Expression recovering the document number from an invoice number.
+    """
+    key = (prefix or "", suffix or "")
+    if key not in _doc_number_res:
+        prefix_re = ".*".join([re.escape(w) for w in re_label.split(key[0])])
+        suffix_re = ".*".join([re.escape(w) for w in re_label.split(key[1])])
+        _doc_number_res[key] = re.compile(prefix_re + r"(\d+)" + suffix_re)
+    return _doc_number_res[key]
+
+
+def _parse_supplier_number(supplier_number):
+    """
+    Return point of sale and number of a supplier voucher number.
+    """
+    result = re_supplier_number.search(supplier_number or '')
+    if not result:
+        return False, False
+    pos, number = result.groups()
+    return int(pos) if pos else False, int(number)
+
 
 def _all_taxes(x):
     return True
@@ -28,21 +61,98 @@ class account_invoice_line(models.Model):
     _name = "account.invoice.line"
     _inherit = "account.invoice.line"
 
-    @api.one
+    @api.multi
     @api.depends('quantity', 'discount', 'price_unit', 'invoice_line_tax_id',
                  'product_id', 'invoice_id.partner_id',
                  'invoice_id.currency_id')
     def compute_price(self, context=None):
-        self.price_unit_vat_included = self.price_calc(use_vat=True, quantity=1)
-        self.price_subtotal_vat_included = self.price_calc(use_vat=True)
-        self.price_unit_not_vat_included = self.price_calc(use_vat=False,
-                                                           quantity=1)
-        self.price_subtotal_not_vat_included = self.price_calc(use_vat=False)
+        for line in self:
+            line.update(line._afip_prices())
+
+    price_unit_vat_included = fields.Float(compute='compute_price',
+                                           store=True)
+    price_subtotal_vat_included = fields.Float(compute='compute_price',
+                                               store=True)
+    price_unit_not_vat_included = fields.Float(compute='compute_price',
+                                               store=True)
+    price_subtotal_not_vat_included = fields.Float(compute='compute_price',
+                                                   store=True)
+
+    # Stored prices, filled by afip_backfill_prices for existing lines.
+    _afip_price_fields = ('price_unit_vat_included',
+                          'price_subtotal_vat_included',
+                          'price_unit_not_vat_included',
+                          'price_subtotal_not_vat_included')
+
+    def _auto_init(self, cr, context=None):
+        """
+        Create the price columns before the ORM, which would compute them
+        for every existing line at once.
+        """
+        cr.execute("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_name = 'account_invoice_line'
+        """)
+        columns = set(r[0] for r in cr.fetchall())
+        for name in self._afip_price_fields:
+            if name not in columns:
+                cr.execute('ALTER TABLE account_invoice_line'
+                           ' ADD COLUMN %s float8' % name)
+        return super(account_invoice_line, self)._auto_init(
+            cr, context=context)
 
-    price_unit_vat_included = fields.Float(compute='compute_price')
-    price_subtotal_vat_included = fields.Float(compute='compute_price')
-    price_unit_not_vat_included = fields.Float(compute='compute_price')
-    price_subtotal_not_vat_included = fields.Float(compute='compute_price')
+    @api.multi
+    def _afip_prices(self):
+        self.ensure_one()
+        return {
+            'price_unit_vat_included':
+            self.price_calc(use_vat=True, quantity=1),
+            'price_subtotal_vat_included':
+            self.price_calc(use_vat=True),
+            'price_unit_not_vat_included':
+            self.price_calc(use_vat=False, quantity=1),
+            'price_subtotal_not_vat_included':
+            self.price_calc(use_vat=False),
+        }
+
+    @api.model
+    def afip_backfill_prices(self, chunk_size=1000, line_ids=None):
+        """
+        Store prices of lines without them, chunk_size lines at a time,
+        only among line_ids when given. Return the number of lines filled.
+        """
+        count = 0
+        last_id = 0
+        while True:
+            self.env.cr.execute("""
+                SELECT id FROM account_invoice_line
+                WHERE price_subtotal_vat_included IS NULL AND id > %s
+                  AND (%s::integer[] IS NULL OR id = ANY(%s::integer[]))
+                ORDER BY id LIMIT %s
+            """, (last_id, line_ids, line_ids, chunk_size))
+            ids = [r[0] for r in self.env.cr.fetchall()]
+            if not ids:
+                break
+            rows = dict((name, []) for name in self._afip_price_fields)
+            for line in self.browse(ids):
+                prices = line._afip_prices()
+                for name in self._afip_price_fields:
+                    rows[name].append(prices[name])
+            self.env.cr.execute("""
+                UPDATE account_invoice_line AS l
+                SET %s
+                FROM unnest(%%s::integer[], %s) AS v(id, %s)
+                WHERE l.id = v.id
+            """ % (', '.join('%s = v.%s' % (n, n)
+                             for n in self._afip_price_fields),
+                   ', '.join(['%s::float8[]'] * len(self._afip_price_fields)),
+                   ', '.join(self._afip_price_fields)),
+                [ids] + [rows[n] for n in self._afip_price_fields])
+            self.env.invalidate_all()
+            count += len(ids)
+            last_id = ids[-1]
+            _logger.info('Stored prices of %i invoice lines' % count)
+        return count
 
     @api.v8
     def price_calc(self, use_vat=True, tax_filter=None, quantity=None,
@@ -53,7 +163,8 @@ class account_invoice_line(models.Model):
         _discount = discount if discount is not None else self.discount
         _price = self.price_unit * (1-(_discount or 0.0)/100.0)
 
-        taxes = self.invoice_line_tax_id.filtered(_tax_filter).compute_all(
+        taxes = self.invoice_line_tax_id.filtered(
+            _tax_filter).afip_compute_all(
             _price, _quantity,
             product=self.product_id,
             partner=self.invoice_id.partner_id
@@ -68,7 +179,8 @@ class account_invoice_line(models.Model):
             _quantity = line.quantity
             _discount = line.discount
             _price = line.price_unit * (1-(_discount or 0.0)/100.0)
-            taxes = line.invoice_line_tax_id.filtered(tax_filter).compute_all(
+            taxes = line.invoice_line_tax_id.filtered(
+                tax_filter).afip_compute_all(
                 _price, _quantity,
                 product=line.product_id,
                 partner=line.invoice_id.partner_id)
@@ -89,6 +201,47 @@ class account_invoice_line(models.Model):
             }
         return res.get(len(self) == 1 and res.keys()[0], res)
 
+    @api.model
+    def afip_tax_memo_stats(self):
+        """
+        Hits and misses of the tax memo in this transaction.
+        """
+        return get_tax_memo(self.env.cr).stats()
+
+    @api.multi
+    def _afip_test_uom(self):
+        """
+        Test all lines have an AFIP unit valid at the invoice date.
+        """
+        if not self:
+            return
+        self.env.cr.execute("""
+            SELECT l.name, u.name, au.name
+            FROM account_invoice_line AS l
+            JOIN account_invoice AS i ON (i.id = l.invoice_id)
+            LEFT JOIN product_uom AS u ON (u.id = l.uos_id)
+            LEFT JOIN product_uom_categ AS c ON (c.id = u.category_id)
+            LEFT JOIN afip_uom AS au
+                ON (au.id = COALESCE(u.afip_uom_id, c.afip_uom_id))
+            WHERE l.id IN %s
+              AND (au.id IS NULL
+                   OR au.valid_from > COALESCE(i.date_invoice, CURRENT_DATE)
+                   OR au.valid_to < COALESCE(i.date_invoice, CURRENT_DATE))
+            LIMIT 1
+        """, (tuple(self.ids),))
+        row = self.env.cr.fetchone()
+        if row:
+            line_name, uom_name, afip_uom_name = row
+            if not uom_name:
+                raise Warning(_('Line %s has no unit of measure.') %
+                              line_name)
+            if not afip_uom_name:
+                raise Warning(_('Unit of measure %s has no AFIP unit'
+                                ' assigned (line %s).') %
+                              (uom_name, line_name))
+            raise Warning(_('AFIP unit %s is not valid at the invoice date'
+                            ' (line %s).') % (afip_uom_name, line_name))
+
 account_invoice_line()
 
 
@@ -107,6 +260,32 @@ def _calc_concept(product_types):
     return concept
 
 
+def _invoice_amounts(invoices, line_filter, tax_filter, context):
+    """
+    Amounts of invoices adding their lines amounts.
+    """
+    res = {}
+    for inv in invoices:
+        amounts = []
+        for line in inv.invoice_line:
+            if line_filter(line):
+                amounts.append(line.compute_all(tax_filter=tax_filter,
+                                                context=context))
+
+        s = {
+            'amount_total': 0,
+            'amount_tax': 0,
+            'amount_untaxed': 0,
+            'taxes': []
+        }
+        for amount in amounts:
+            for key, value in amount.items():
+                s[key] = s.get(key, 0) + value
+
+        res[inv.id] = s
+    return res
+
+
 class account_invoice(models.Model):
     """
     Argentine invoice functions.
@@ -169,7 +348,7 @@ class account_invoice(models.Model):
             return False
 
     afip_doc_number = fields.Integer(compute='_get_afip_doc_number',
-                                     string='Document number')
+                                     string='Document number', store=True)
     afip_concept = fields.Selection(
         [('1', 'Consumible'), ('2', 'Service'), ('3', 'Mixted')],
         compute="_get_concept",
@@ -185,6 +364,29 @@ class account_invoice(models.Model):
     afip_obs = fields.Text('Commercial observations')
     afip_for_export = fields.Boolean(compute='_get_afip_for_export',
                                      string='Is for export')
+    afip_supplier_pos = fields.Integer(
+        compute='_get_afip_supplier_number', store=True,
+        string='Supplier point of sale')
+    afip_supplier_number = fields.Integer(
+        compute='_get_afip_supplier_number', store=True,
+        string='Supplier voucher number')
+    afip_partner_document = fields.Char(
+        related='partner_id.document_number_normalized', store=True,
+        string='Partner document number')
+    afip_journal_class_code = fields.Integer(
+        related='journal_id.journal_class_id.afip_code', store=True,
+        string='Journal class AFIP code')
+    afip_cae = fields.Char('CAE', size=14, readonly=True, copy=False,
+                           help="Electronic authorization code given by"
+                           " AFIP.")
+    afip_cae_due = fields.Date('CAE due date', readonly=True, copy=False)
+
+    @api.multi
+    @api.depends('supplier_invoice_number')
+    def _get_afip_supplier_number(self):
+        for inv in self:
+            inv.afip_supplier_pos, inv.afip_supplier_number = \
+                _parse_supplier_number(inv.supplier_invoice_number)
 
     @api.multi
     @api.depends('number',
@@ -199,15 +401,8 @@ class account_invoice(models.Model):
                 inv.afip_doc_number = False
                 continue
 
-            prefix_re = ".*".join([
-                re.escape(w)
-                for w in re_label.split(inv.journal_id.sequence_id.prefix or "")
-            ])
-            suffix_re = ".*".join([
-                re.escape(w)
-                for w in re_label.split(inv.journal_id.sequence_id.suffix or "")
-            ])
-            re_number = re.compile(prefix_re + r"(\d+)" + suffix_re)
+            re_number = _doc_number_re(inv.journal_id.sequence_id.prefix,
+                                       inv.journal_id.sequence_id.suffix)
             result = re_number.search(inv.number)
             if result:
                 inv.afip_doc_number = int(result.group(1))
@@ -248,6 +443,7 @@ class account_invoice(models.Model):
         """
         Test documentation
         """
+        relation_obj = self.env['afip.responsability_relation']
         for invoice in self:
             if invoice.type in ('out_invoice', 'out_refund'):
                 ori_partner = invoice.company_id.partner_id
@@ -266,25 +462,18 @@ class account_invoice(models.Model):
             # Take responsability classes for this journal
             invoice_class = \
                 invoice.journal_id.journal_class_id.document_class_id
-            resp_class = \
-                self.env['afip.responsability_relation'].search(
-                    [('document_class_id', '=', invoice_class.id),
-                     ('issuer_id.code', '=', ori_partner.responsability_id.code)])
 
             # You can emmit this document?
-            if not resp_class:
+            if not relation_obj.can_issue(invoice_class.id,
+                                          ori_partner.responsability_id.code):
                 raise Warning(
                     _('Invalid emisor\n'
                       'Your responsability with AFIP dont let you generate'
                       ' this kind of document.'))
 
             # Partner can receive this document?
-            resp_class = \
-                self.env['afip.responsability_relation'].search([
-                    ('document_class_id', '=', invoice_class.id),
-                    ('receptor_id.code', '=', dst_partner.responsability_id.code)
-                ])
-            if not resp_class:
+            if not relation_obj.can_receive(
+                    invoice_class.id, dst_partner.responsability_id.code):
                 raise Warning(
                     _('Invalid receptor\n'
                       'Your partner (%s) can\'t receive this document (%s).'
@@ -331,44 +520,129 @@ class account_invoice(models.Model):
                     raise Warning(_('Service dates are wrong'))
 
     @api.multi
-    def afip_validation(self):
+    def _afip_test_export(self):
         """
-        Check basic AFIP request to generate invoices.
+        Test export destination
         """
-        for invoice in self:
-            # If company is not in Argentina, ignore it.
-            if invoice.company_id.partner_id.country_id.name != 'Argentina':
+        exports = self.filtered(lambda inv: inv.afip_for_export)
+        for invoice in exports:
+            if not invoice.partner_id._afip_get_destination():
+                raise Warning(
+                    _('No export destination\n'
+                      'Partner %s has no AFIP destination and none is'
+                      ' associated to its country or state.') %
+                    invoice.partner_id.name)
+        exports.mapped('invoice_line')._afip_test_uom()
+
+    @api.multi
+    def _afip_test_duplicate(self):
+        """
+        Test supplier vouchers are not loaded twice, archived ones included
+        """
+        supplier = self.filtered(
+            lambda inv: inv.type in ('in_invoice', 'in_refund') and
+            inv.afip_supplier_number)
+        if not supplier:
+            return
+        self.env.cr.execute("""
+            SELECT i.supplier_invoice_number, d.number, d.id
+            FROM account_invoice AS i
+            JOIN afip_invoice_history AS d ON (
+                d.afip_partner_document = i.afip_partner_document
+                AND d.afip_journal_class_code = i.afip_journal_class_code
+                AND d.afip_supplier_pos = i.afip_supplier_pos
+                AND d.afip_supplier_number = i.afip_supplier_number
+                AND d.type IN ('in_invoice', 'in_refund')
+                AND d.state != 'cancel'
+                AND d.id != i.id)
+            WHERE i.id IN %s
+            LIMIT 1
+        """, (tuple(supplier.ids),))
+        row = self.env.cr.fetchone()
+        if row:
+            raise Warning(
+                _('Repeated supplier voucher\n'
+                  'Supplier voucher %s was already loaded (%s).') %
+                (row[0], row[1] or row[2]))
+
+    @api.model
+    def afip_find_supplier_duplicates(self, rows):
+        """
+        Check a whole import at once. rows is a list of tuples
+        (document number, journal class AFIP code, supplier voucher number).
+
+        Return a list of (row index, invoice id) for rows already loaded,
+        archived ones included, and (row index, False) for rows repeated in
+        the import itself.
+        """
+        indexes, docs, codes, poss, numbers = [], [], [], [], []
+        seen = set()
+        res = []
+        for idx, (doc, code, supplier_number) in enumerate(rows):
+            # Stored integers hold 0 for a missing point of sale or number.
+            doc = normalize_document(doc) or None
+            pos, number = _parse_supplier_number(supplier_number)
+            pos, number = pos or 0, number or 0
+            key = (doc, code, pos, number)
+            if key in seen:
+                res.append((idx, False))
                 continue
+            seen.add(key)
+            indexes.append(idx)
+            docs.append(doc)
+            codes.append(code)
+            poss.append(pos)
+            numbers.append(number)
+
+        if not docs:
+            return res
+
+        self.env.cr.execute("""
+            SELECT v.idx - 1, i.id
+            FROM unnest(%s::varchar[], %s::integer[], %s::integer[],
+                        %s::integer[])
+                 WITH ORDINALITY AS v(doc, code, pos, num, idx)
+            JOIN afip_invoice_history AS i ON (
+                i.afip_partner_document = v.doc
+                AND i.afip_journal_class_code = v.code
+                AND i.afip_supplier_pos = v.pos
+                AND i.afip_supplier_number = v.num)
+            WHERE i.type IN ('in_invoice', 'in_refund')
+              AND i.state != 'cancel'
+        """, (docs, codes, poss, numbers))
+        res.extend((indexes[pos], inv_id)
+                   for pos, inv_id in self.env.cr.fetchall())
+        return sorted(res)
 
-            self._afip_test_journal()
-            self._afip_test_document()
-            self._afip_test_limits()
-            self._afip_test_lines()
+    @api.multi
+    def afip_validation(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Check basic AFIP request to generate invoices.
+        """
+        for chunk in iter_chunks(self, chunk_size,
+                                 label=len(self) > chunk_size and
+                                 'AFIP validation'):
+            # If company is not in Argentina, ignore it.
+            invoices = chunk.filtered(
+                lambda inv:
+                inv.company_id.partner_id.country_id.name == 'Argentina')
+
+            invoices._afip_test_journal()
+            invoices._afip_test_document()
+            invoices._afip_test_limits()
+            invoices._afip_test_lines()
+            invoices._afip_test_product_types()
+            invoices._afip_test_export()
+            invoices._afip_test_duplicate()
 
         return True
 
     def compute_all(self, cr, uid, ids, line_filter=lambda line: True,
                     tax_filter=lambda tax: True, context=None):
         res = {}
-        for inv in self.browse(cr, uid, ids, context=context):
-            amounts = []
-            for line in inv.invoice_line:
-                if line_filter(line):
-                    amounts.append(line.compute_all(tax_filter=tax_filter,
-                                                    context=context))
-
-            s = {
-                'amount_total': 0,
-                'amount_tax': 0,
-                'amount_untaxed': 0,
-                'taxes': []
-            }
-            for amount in amounts:
-                for key, value in amount.items():
-                    s[key] = s.get(key, 0) + value
-
-            res[inv.id] = s
-
+        for chunk in iter_chunks(self.browse(cr, uid, ids, context=context)):
+            res.update(_invoice_amounts(chunk, line_filter, tax_filter,
+                                        context))
         return res.get(len(ids) == 1 and ids[0], res)
 
     @api.multi
@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+from openerp import api, models, fields, tools, _
+from openerp.exceptions import Warning
+import psycopg2
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Tables moved to the archive, with the column relating each row to an
+# invoice or invoice line and the table it points to, in insertion order.
+_archive_tables = [
+    ('account_invoice', 'id', 'account_invoice'),
+    ('account_invoice_line', 'invoice_id', 'account_invoice'),
+    ('account_invoice_tax', 'invoice_id', 'account_invoice'),
+    ('account_invoice_line_tax', 'invoice_line_id', 'account_invoice_line'),
+]
+
+# Tables pointing to records by model name and id, with their model column.
+# Rows of archived invoices are moved to afip.invoice_history, which keeps
+# reading the invoices by the same id, and moved back on restore.
+_model_references = [
+    ('mail_message', 'model'),
+    ('mail_followers', 'res_model'),
+    ('ir_attachment', 'res_model'),
+]
+
+# Columns read through the history views, by view.
+_history_views = {
+    'afip_invoice_history': ('account_invoice', [
+        'id', 'number', 'type', 'state', 'date_invoice', 'date_due',
+        'company_id', 'partner_id', 'journal_id', 'period_id',
+        'currency_id', 'amount_untaxed', 'amount_tax', 'amount_total',
+        'afip_doc_number', 'afip_partner_document',
+        'afip_journal_class_code', 'afip_supplier_pos',
+        'afip_supplier_number', 'afip_cae', 'afip_cae_due',
+        'payment_term', 'afip_incoterm_id', 'afip_incoterm_description',
+        'afip_commercial_obs', 'afip_obs']),
+    'afip_invoice_line_history': ('account_invoice_line', [
+        'id', 'invoice_id', 'sequence', 'name', 'product_id', 'uos_id',
+        'quantity', 'price_unit', 'discount', 'price_subtotal',
+        'price_unit_vat_included', 'price_subtotal_vat_included',
+        'price_unit_not_vat_included', 'price_subtotal_not_vat_included']),
+}
+
+
+def _archive_table(table, year):
+    return 'afip_archive_%s_%i' % (table[len('account_'):], year)
+
+
+def _table_columns(cr, table):
+    """
+    Columns of table with their SQL type, in table order.
+    """
+    cr.execute("""
+        SELECT a.attname, format_type(a.atttypid, a.atttypmod)
+        FROM pg_attribute a
+        JOIN pg_class c ON c.oid = a.attrelid
+        WHERE c.relname = %s AND c.relkind = 'r'
+          AND a.attnum > 0 AND NOT a.attisdropped
+        ORDER BY a.attnum
+    """, (table,))
+    return cr.fetchall()
+
+
+def _archive_years(cr):
+    cr.execute("""
+        SELECT substring(relname from '[0-9]{4}$')::integer
+        FROM pg_class
+        WHERE relname ~ '^afip_archive_invoice_[0-9]{4}$' AND relkind = 'r'
+        ORDER BY 1
+    """)
+    return [r[0] for r in cr.fetchall()]
+
+
+def _ensure_archive_table(cr, table, year, key):
+    """
+    Create the archive of table for year, or add the columns table got
+    since it was created.
+    """
+    archive = _archive_table(table, year)
+    archived = dict(_table_columns(cr, archive))
+    if not archived:
+        cr.execute('CREATE TABLE "%s" (LIKE "%s")' % (archive, table))
+        cr.execute('CREATE INDEX "%s_%s_index" ON "%s" ("%s")' %
+                   (archive, key, archive, key))
+        return archive
+    for name, sql_type in _table_columns(cr, table):
+        if name not in archived:
+            cr.execute('ALTER TABLE "%s" ADD COLUMN "%s" %s' %
+                       (archive, name, sql_type))
+    return archive
+
+
+def create_history_view(cr, view):
+    """
+    (Re)create view as the union of the hot table and its archives.
+    """
+    table, columns = _history_views[view]
+    key = dict((t, k) for t, k, target in _archive_tables)[table]
+    select = ', '.join('"%s"' % c for c in columns)
+    queries = ['SELECT %s, NULL::integer AS archive_year FROM "%s"' %
+               (select, table)]
+    for year in _archive_years(cr):
+        archive = _ensure_archive_table(cr, table, year, key)
+        queries.append('SELECT %s, %i FROM "%s"' % (select, year, archive))
+    tools.drop_view_if_exists(cr, view)
+    cr.execute('CREATE VIEW %s AS (%s)' % (view, ' UNION ALL '.join(queries)))
+
+
+class afip_invoice_archive(models.Model):
+    """
+    Invoices of a fiscal year moved to year tables.
+
+    Archiving moves paid and cancelled invoices, with their lines, taxes
+    and stored AFIP fields, out of the invoice tables into tables of the
+    year, so daily queries and indexes only hold recent invoices.
+    Invoices referenced from other tables or with external ids stay in
+    place. Archived invoices are read through afip.invoice_history and
+    afip.invoice_line_history, where their messages, followers and
+    attachments go, and restoring moves them back.
+    """
+    _name = 'afip.invoice_archive'
+    _description = 'AFIP invoice archive'
+    _order = 'year desc'
+    _rec_name = 'fiscalyear_id'
+
+    fiscalyear_id = fields.Many2one('account.fiscalyear', 'Fiscal year',
+                                    required=True, ondelete='restrict')
+    company_id = fields.Many2one(related='fiscalyear_id.company_id',
+                                 string='Company', readonly=True)
+    year = fields.Integer('Archive year', compute='_get_year', store=True,
+                          help="Year of the tables invoices are moved to.")
+    state = fields.Selection([('hot', 'In use'), ('archived', 'Archived')],
+                             'State', default='hot', readonly=True)
+    invoice_count = fields.Integer('Invoices', readonly=True)
+    line_count = fields.Integer('Lines', readonly=True)
+    date_done = fields.Datetime('Last moved', readonly=True)
+
+    _sql_constraints = [
+        ('fiscalyear_uniq', 'unique(fiscalyear_id)',
+         'There is already an archive for this fiscal year.'),
+    ]
+
+    @api.one
+    @api.depends('fiscalyear_id.date_stop')
+    def _get_year(self):
+        self.year = self.fiscalyear_id.date_stop and \
+            int(self.fiscalyear_id.date_stop[:4])
+
+    @api.multi
+    def _select_invoices(self, query, params):
+        """
+        Keep ids returned by query as the invoices to move.
+        """
+        cr = self.env.cr
+        cr.execute("DROP TABLE IF EXISTS afip_archive_ids")
+        cr.execute("CREATE TEMP TABLE afip_archive_ids"
+                   " (id integer PRIMARY KEY) ON COMMIT DROP")
+        cr.execute("INSERT INTO afip_archive_ids " + query, params)
+
+    @api.model
+    def _exclude_referenced(self):
+        """
+        Keep in place invoices whose invoice or lines are referenced by
+        foreign keys from tables not archived, and invoices with external
+        ids, which modules expect to find.
+        """
+        cr = self.env.cr
+        cr.execute("""
+            DELETE FROM afip_archive_ids WHERE id IN (
+                SELECT res_id FROM ir_model_data
+                WHERE model = 'account.invoice')
+        """)
+        cr.execute("""
+            SELECT r.relname, a.attname, t.relname
+            FROM pg_constraint c
+            JOIN pg_class r ON r.oid = c.conrelid
+            JOIN pg_class t ON t.oid = c.confrelid
+            JOIN pg_attribute a ON a.attrelid = c.conrelid
+                               AND a.attnum = c.conkey[1]
+            WHERE c.contype = 'f'
+              AND t.relname IN ('account_invoice', 'account_invoice_line')
+              AND r.relname NOT IN %s
+        """, (tuple(t for t, k, target in _archive_tables),))
+        for table, column, target in cr.fetchall():
+            if target == 'account_invoice':
+                query = 'SELECT "%s" FROM "%s"' % (column, table)
+            else:
+                query = """
+                    SELECT l.invoice_id FROM account_invoice_line l
+                    JOIN "%s" r ON r."%s" = l.id""" % (table, column)
+            cr.execute("DELETE FROM afip_archive_ids WHERE id IN (%s)" %
+                       query)
+            if cr.rowcount:
+                _logger.info('Keeping %i invoices referenced from %s' %
+                             (cr.rowcount, table))
+
+    @api.multi
+    def _move_invoices(self, to_archive):
+        """
+        Move the selected invoices between the invoice tables and the
+        archive tables of the year. Return the rows moved by table.
+        """
+        self.ensure_one()
+        cr = self.env.cr
+
+        def source(table):
+            return table if to_archive else _archive_table(table, self.year)
+
+        def where(key, target):
+            if target == 'account_invoice':
+                return '"%s" IN (SELECT id FROM afip_archive_ids)' % key
+            return ('"%s" IN (SELECT id FROM "%s" WHERE invoice_id IN'
+                    ' (SELECT id FROM afip_archive_ids))' %
+                    (key, source('account_invoice_line')))
+
+        counts = {}
+        for table, key, target in _archive_tables:
+            archive = _ensure_archive_table(cr, table, self.year, key)
+            src, dst = (table, archive) if to_archive else (archive, table)
+            dst_columns = set(c for c, t in _table_columns(cr, dst))
+            columns = ', '.join('"%s"' % c for c, t in
+                                _table_columns(cr, src) if c in dst_columns)
+            cr.execute('INSERT INTO "%s" (%s) SELECT %s FROM "%s" WHERE %s' %
+                       (dst, columns, columns, src, where(key, target)))
+            counts[table] = cr.rowcount
+        for table, key, target in reversed(_archive_tables):
+            cr.execute('DELETE FROM "%s" WHERE %s' %
+                       (source(table), where(key, target)))
+
+        old, new = 'account.invoice', 'afip.invoice_history'
+        if not to_archive:
+            old, new = new, old
+        for table, column in _model_references:
+            cr.execute('UPDATE "%s" SET "%s" = %%s WHERE "%s" = %%s'
+                       ' AND res_id IN (SELECT id FROM afip_archive_ids)' %
+                       (table, column, column), (new, old))
+        return counts
+
+    @api.multi
+    def _move(self, to_archive):
+        self.ensure_one()
+        fy = self.fiscalyear_id
+        if to_archive:
+            self._select_invoices("""
+                SELECT id FROM account_invoice
+                WHERE company_id = %s AND state IN ('paid', 'cancel')
+                  AND date_invoice BETWEEN %s AND %s
+            """, (fy.company_id.id, fy.date_start, fy.date_stop))
+            self._exclude_referenced()
+        else:
+            self._select_invoices("""
+                SELECT id FROM "%s"
+                WHERE company_id = %%s AND date_invoice BETWEEN %%s AND %%s
+            """ % _archive_table('account_invoice', self.year),
+                (fy.company_id.id, fy.date_start, fy.date_stop))
+        try:
+            with self.env.cr.savepoint():
+                counts = self._move_invoices(to_archive)
+        except psycopg2.IntegrityError as e:
+            raise Warning(_('Invoices not moved\n%s') % tools.ustr(e))
+        self.env.invalidate_all()
+        for view in _history_views:
+            create_history_view(self.env.cr, view)
+
+        _logger.info('%s %i invoices and %i lines of %s' % (
+            'Archived' if to_archive else 'Restored',
+            counts['account_invoice'], counts['account_invoice_line'],
+            fy.name))
+        return counts
+
+    @api.multi
+    def action_archive(self):
+        for archive in self:
+            counts = archive._move(True)
+            archive.write({
+                'state': 'archived',
+                'invoice_count': archive.invoice_count +
+                counts['account_invoice'],
+                'line_count': archive.line_count +
+                counts['account_invoice_line'],
+                'date_done': fields.Datetime.now(),
+            })
+        return True
+
+    @api.multi
+    def action_restore(self):
+        for archive in self.filtered(lambda a: a.state == 'archived'):
+            archive._move(False)
+            archive.write({
+                'state': 'hot',
+                'invoice_count': 0,
+                'line_count': 0,
+                'date_done': fields.Datetime.now(),
+            })
+        return True
+
+
+class afip_invoice_history(models.Model):
+    """
+    Invoices in use and archived, for exports and audits.
+    """
+    _name = 'afip.invoice_history'
+    _description = 'AFIP invoice history'
+    _auto = False
+    _order = 'date_invoice desc, id desc'
+    _rec_name = 'number'
+
+    number = fields.Char('Number', readonly=True)
+    type = fields.Selection([
+        ('out_invoice', 'Customer Invoice'),
+        ('in_invoice', 'Supplier Invoice'),
+        ('out_refund', 'Customer Refund'),
+        ('in_refund', 'Supplier Refund'),
+    ], 'Type', readonly=True)
+    state = fields.Selection([
+        ('draft', 'Draft'),
+        ('proforma', 'Pro-forma'),
+        ('proforma2', 'Pro-forma'),
+        ('open', 'Open'),
+        ('paid', 'Paid'),
+        ('cancel', 'Cancelled'),
+    ], 'Status', readonly=True)
+    date_invoice = fields.Date('Invoice date', readonly=True)
+    date_due = fields.Date('Due date', readonly=True)
+    company_id = fields.Many2one('res.company', 'Company', readonly=True)
+    partner_id = fields.Many2one('res.partner', 'Partner', readonly=True)
+    journal_id = fields.Many2one('account.journal', 'Journal', readonly=True)
+    period_id = fields.Many2one('account.period', 'Period', readonly=True)
+    currency_id = fields.Many2one('res.currency', 'Currency', readonly=True)
+    amount_untaxed = fields.Float('Untaxed', readonly=True)
+    amount_tax = fields.Float('Tax', readonly=True)
+    amount_total = fields.Float('Total', readonly=True)
+    afip_doc_number = fields.Integer('Document number', readonly=True)
+    afip_partner_document = fields.Char('Partner document number',
+                                        readonly=True)
+    afip_journal_class_code = fields.Integer('Journal class AFIP code',
+                                             readonly=True)
+    afip_supplier_pos = fields.Integer('Supplier point of sale',
+                                       readonly=True)
+    afip_supplier_number = fields.Integer('Supplier number', readonly=True)
+    afip_cae = fields.Char('CAE', readonly=True)
+    afip_cae_due = fields.Date('CAE due date', readonly=True)
+    payment_term = fields.Many2one('account.payment.term', 'Payment terms',
+                                   readonly=True)
+    afip_incoterm_id = fields.Many2one('afip.incoterm', 'Incoterm',
+                                       readonly=True)
+    afip_incoterm_description = fields.Text('Incoterm description',
+                                            readonly=True)
+    afip_commercial_obs = fields.Text('Commercial observations',
+                                      readonly=True)
+    afip_obs = fields.Text('Observations', readonly=True)
+    archive_year = fields.Integer('Archive year', readonly=True,
+                                  help="Empty for invoices in use.")
+    line_ids = fields.One2many('afip.invoice_line_history', 'invoice_id',
+                               'Lines', readonly=True)
+
+    def init(self, cr):
+        create_history_view(cr, self._table)
+
+
+class afip_invoice_line_history(models.Model):
+    """
+    Invoice lines in use and archived, for exports and audits.
+    """
+    _name = 'afip.invoice_line_history'
+    _description = 'AFIP invoice line history'
+    _auto = False
+    _order = 'invoice_id, sequence, id'
+
+    invoice_id = fields.Many2one('afip.invoice_history', 'Invoice',
+                                 readonly=True)
+    sequence = fields.Integer('Sequence', readonly=True)
+    name = fields.Text('Description', readonly=True)
+    product_id = fields.Many2one('product.product', 'Product', readonly=True)
+    uos_id = fields.Many2one('product.uom', 'Unit of measure', readonly=True)
+    quantity = fields.Float('Quantity', readonly=True)
+    price_unit = fields.Float('Unit price', readonly=True)
+    discount = fields.Float('Discount (%)', readonly=True)
+    price_subtotal = fields.Float('Amount', readonly=True)
+    price_unit_vat_included = fields.Float('Unit price VAT included',
+                                           readonly=True)
+    price_subtotal_vat_included = fields.Float('Subtotal VAT included',
+                                               readonly=True)
+    price_unit_not_vat_included = fields.Float('Unit price VAT excluded',
+                                               readonly=True)
+    price_subtotal_not_vat_included = fields.Float(
+        'Subtotal VAT excluded', readonly=True)
+    archive_year = fields.Integer('Archive year', readonly=True)
+
+    def init(self, cr):
+        create_history_view(cr, self._table)
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+from openerp import api, models, fields, _
+from openerp.exceptions import Warning
+from .replica import afip_read_env
+from .chunked import iter_chunks
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Export types by AFIP concept.
+_export_type = {'1': 1, '2': 2, '3': 4}
+
+
+class afip_invoice_history(models.Model):
+    """
+    Build export authorization requests from invoices in use or archived.
+    """
+    _inherit = "afip.invoice_history"
+
+    @api.multi
+    @api.depends('line_ids.product_id.type')
+    def _get_concept(self):
+        """
+        Compute concept type from the products of the invoice lines.
+        """
+        concept_obj = self.env['afip.concept_type']
+        for inv in self:
+            product_types = set([
+                line.product_id.type for line in inv.line_ids
+            ])
+            inv.afip_concept = concept_obj.get_code(product_types) \
+                if False not in product_types \
+                else False
+
+    afip_concept = fields.Selection(
+        [('1', 'Consumible'), ('2', 'Service'), ('3', 'Mixted')],
+        compute="_get_concept", string="AFIP concept")
+
+    @api.model
+    def _afip_export_lookups(self):
+        """
+        Reference values shared by all invoices of a batch.
+        """
+        return {
+            'lang': dict((l['code'], l['afip_code'])
+                         for l in self.env['res.lang'].search_read(
+                             [], ['code', 'afip_code'])),
+            'destination': {},
+            'rate': {},
+            'currency': self.env['res.currency']._get_afip_code_map(),
+        }
+
+    @api.multi
+    def _afip_export_item(self, line):
+        return {
+            'Pro_codigo': line.product_id.default_code or '',
+            'Pro_ds': line.name,
+            'Pro_qty': line.quantity,
+            'Pro_umed': line.uos_id.afip_code,
+            'Pro_precio_uni': line.price_unit,
+            'Pro_bonificacion': line.price_unit * line.quantity *
+            (line.discount or 0.0) / 100.0,
+            'Pro_total_item': line.price_subtotal,
+        }
+
+    @api.multi
+    def _afip_export_request(self, lookups):
+        """
+        Export authorization request of one invoice.
+        """
+        self.ensure_one()
+        partner = self.partner_id
+        currency = self.currency_id
+
+        dest_key = (partner.id, partner.afip_destination_id.id,
+                    partner.country_id.id, partner.state_id.id)
+        if dest_key not in lookups['destination']:
+            lookups['destination'][dest_key] = \
+                partner._afip_get_destination()
+        destination = lookups['destination'][dest_key]
+
+        date_invoice = self.date_invoice or fields.Date.context_today(self)
+        rate_key = (currency.id, self.company_id.currency_id.id, date_invoice)
+        if rate_key not in lookups['rate']:
+            lookups['rate'][rate_key] = self.env['res.currency'].with_context(
+                date=date_invoice)._get_conversion_rate(
+                    currency, self.company_id.currency_id)
+        rate = lookups['rate'][rate_key]
+
+        return {
+            'Id': self.id,
+            'Fecha_cbte': date_invoice.replace('-', ''),
+            'Cbte_Tipo': self.journal_id.journal_class_id.afip_code,
+            'Punto_vta': self.journal_id.point_of_sale,
+            'Cbte_nro': self.afip_doc_number,
+            'Tipo_expo': _export_type.get(self.afip_concept, 4),
+            'Dst_cmp': destination.afip_code,
+            'Cliente': partner.name,
+            'Cuit_pais_cliente': partner.is_company and
+            destination.afip_cuit_company or destination.afip_cuit_person,
+            'Domicilio_cliente': partner.contact_address,
+            'Id_impositivo': partner.vat or partner.document_number or '',
+            'Moneda_Id': lookups['currency'].get(currency.id),
+            'Moneda_ctz': rate,
+            'Obs_comerciales': self.afip_commercial_obs or '',
+            'Imp_total': self.amount_total,
+            'Obs': self.afip_obs or '',
+            'Forma_pago': self.payment_term.name or '',
+            'Incoterms': self.afip_incoterm_id.afip_code or '',
+            'Incoterms_Ds': self.afip_incoterm_description or '',
+            'Idioma_cbte': lookups['lang'].get(partner.lang) or 1,
+            'Items': [self._afip_export_item(line)
+                      for line in self.line_ids],
+        }
+
+
+class account_invoice(models.Model):
+    """
+    Build export authorization requests from invoices.
+    """
+    _inherit = "account.invoice"
+
+    @api.multi
+    def afip_export_requests(self, chunk_size=200, use_replica=False):
+        """
+        Yield export authorization requests for the export invoices.
+
+        Invoices are read through afip.invoice_history, so archived ones
+        can be exported too, by chunks; all records of a chunk are
+        prefetched together and the cache is cleared before reading the
+        next one. Invoices not for export are searched in the database, so
+        the whole recordset is never loaded at once.
+        With use_replica, they are read from the configured read only
+        replica.
+        """
+        if use_replica:
+            with afip_read_env(self.env) as env:
+                for request in self.with_env(env).afip_export_requests(
+                        chunk_size=chunk_size):
+                    yield request
+            return
+
+        history = self.env['afip.invoice_history']
+        not_export = history.search([
+            ('id', 'in', self.ids),
+            '|', '|', ('journal_id', '=', False),
+            ('journal_id.journal_class_id', '=', False),
+            ('journal_id.journal_class_id.afip_code', 'not in',
+             [19, 20, 21])])
+        if not_export:
+            raise Warning(_('Invoices %s are not for export.') %
+                          ', '.join(n for n in not_export.mapped('number')
+                                    if n))
+
+        lookups = history._afip_export_lookups()
+        for chunk in iter_chunks(history.browse(self.ids), chunk_size):
+            for invoice in chunk:
+                yield invoice._afip_export_request(lookups)
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
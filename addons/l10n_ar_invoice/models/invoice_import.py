@@ -0,0 +1,584 @@
+# -*- coding: utf-8 -*-
+from openerp import api, models, fields, _
+from openerp.exceptions import Warning
+import csv
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# References at fault listed by each check.
+_max_reported = 5
+
+
+class afip_invoice_import(models.AbstractModel):
+    """
+    Load historical vouchers, already numbered and authorized, straight
+    into the invoice tables.
+
+    Files are CSV with field names as header, loaded with COPY into
+    temporary tables where references are resolved in bulk. Invoices keep
+    their point of sale, number and CAE, the stored AFIP fields and line
+    prices are set directly and their workflow starts at the open or paid
+    activity. No accounting move is made, so balances must be loaded
+    apart. The result is checked with aggregate queries and any
+    difference aborts the import.
+
+    Invoices: ref, type, afip_code (journal class), point_of_sale, number,
+    date_invoice, date_due, partner_document, currency, amount_untaxed,
+    amount_tax, amount_total, cae, cae_due, state (open or paid).
+
+    Lines: invoice_ref, sequence, name, product (default code), account
+    (code), quantity, price_unit, discount, price_subtotal, taxes (tax
+    names separated by |).
+
+    Taxes: invoice_ref, tax (name), base, amount.
+    """
+    _name = 'afip.invoice_import'
+    _description = 'AFIP historical invoices import'
+
+    # File columns and the type they are loaded as.
+    _import_columns = {
+        'invoice': [
+            ('ref', 'varchar'),
+            ('type', 'varchar'),
+            ('afip_code', 'integer'),
+            ('point_of_sale', 'integer'),
+            ('number', 'integer'),
+            ('date_invoice', 'date'),
+            ('date_due', 'date'),
+            ('partner_document', 'varchar'),
+            ('currency', 'varchar'),
+            ('amount_untaxed', 'numeric'),
+            ('amount_tax', 'numeric'),
+            ('amount_total', 'numeric'),
+            ('cae', 'varchar'),
+            ('cae_due', 'date'),
+            ('state', 'varchar'),
+        ],
+        'line': [
+            ('invoice_ref', 'varchar'),
+            ('sequence', 'integer'),
+            ('name', 'text'),
+            ('product', 'varchar'),
+            ('account', 'varchar'),
+            ('quantity', 'numeric'),
+            ('price_unit', 'numeric'),
+            ('discount', 'numeric'),
+            ('price_subtotal', 'numeric'),
+            ('taxes', 'varchar'),
+        ],
+        'tax': [
+            ('invoice_ref', 'varchar'),
+            ('tax', 'varchar'),
+            ('base', 'numeric'),
+            ('amount', 'numeric'),
+        ],
+    }
+
+    # Columns filled while resolving references.
+    _resolved_columns = {
+        'invoice': [
+            ('id', 'integer'),
+            ('journal_id', 'integer'),
+            ('partner_id', 'integer'),
+            ('currency_id', 'integer'),
+            ('period_id', 'integer'),
+            ('account_id', 'integer'),
+            ('rate', 'numeric'),
+        ],
+        'line': [
+            ('id', 'integer'),
+            ('invoice_id', 'integer'),
+            ('product_id', 'integer'),
+            ('uos_id', 'integer'),
+            ('account_id', 'integer'),
+        ],
+        'tax': [
+            ('invoice_id', 'integer'),
+            ('tax_id', 'integer'),
+        ],
+    }
+
+    # Staged rows that can not be imported: message and query returning
+    # the invoice references at fault. Messages are marked for translation
+    # here and translated when reported.
+    _staged_checks = [
+        (_('Repeated reference'), """
+            SELECT ref FROM afip_import_invoice
+            GROUP BY ref HAVING count(*) > 1
+        """),
+        (_('Unknown state'), """
+            SELECT ref FROM afip_import_invoice
+            WHERE state NOT IN ('open', 'paid')
+        """),
+        (_('No journal for voucher type and point of sale'), """
+            SELECT ref FROM afip_import_invoice WHERE journal_id IS NULL
+        """),
+        (_('No partner with document number'), """
+            SELECT ref FROM afip_import_invoice WHERE partner_id IS NULL
+        """),
+        (_('No open period for date'), """
+            SELECT ref FROM afip_import_invoice WHERE period_id IS NULL
+        """),
+        (_('Partner without receivable or payable account'), """
+            SELECT ref FROM afip_import_invoice WHERE account_id IS NULL
+        """),
+        (_('Line of unknown invoice'), """
+            SELECT invoice_ref FROM afip_import_line WHERE invoice_id IS NULL
+            UNION ALL
+            SELECT invoice_ref FROM afip_import_tax WHERE invoice_id IS NULL
+        """),
+        (_('Line without account'), """
+            SELECT invoice_ref FROM afip_import_line WHERE account_id IS NULL
+        """),
+        (_('Unknown tax'), """
+            SELECT invoice_ref FROM afip_import_tax WHERE tax_id IS NULL
+            UNION ALL
+            SELECT l.invoice_ref
+            FROM afip_import_line AS l,
+                 unnest(string_to_array(l.taxes, '|')) AS n(name)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM account_tax AS x
+                WHERE x.name = n.name AND x.company_id = %(company)s)
+        """),
+        (_('Number already used'), """
+            SELECT s.ref FROM afip_import_invoice AS s
+            WHERE s.type IN ('out_invoice', 'out_refund')
+              AND (EXISTS (
+                    SELECT 1 FROM afip_invoice_history AS i
+                    WHERE i.journal_id = s.journal_id
+                      AND i.afip_doc_number = s.number)
+                OR EXISTS (
+                    SELECT 1 FROM afip_import_invoice AS o
+                    WHERE o.journal_id = s.journal_id
+                      AND o.number = s.number AND o.ref != s.ref))
+            UNION ALL
+            SELECT s.ref FROM afip_import_invoice AS s
+            JOIN res_partner AS p ON (p.id = s.partner_id)
+            WHERE s.type IN ('in_invoice', 'in_refund')
+              AND EXISTS (
+                SELECT 1 FROM afip_invoice_history AS i
+                WHERE i.afip_partner_document = p.document_number_normalized
+                  AND i.afip_journal_class_code = s.afip_code
+                  AND i.afip_supplier_pos = s.point_of_sale
+                  AND i.afip_supplier_number = s.number
+                  AND i.type IN ('in_invoice', 'in_refund')
+                  AND i.state != 'cancel')
+        """),
+    ]
+
+    # Imported invoices that do not add up: message and query returning
+    # the invoice references at fault.
+    _imported_checks = [
+        (_('Lines do not add up to untaxed amount'), """
+            SELECT s.ref
+            FROM afip_import_invoice AS s
+            JOIN account_invoice AS i ON (i.id = s.id)
+            JOIN res_currency AS c ON (c.id = i.currency_id)
+            LEFT JOIN account_invoice_line AS l ON (l.invoice_id = i.id)
+            GROUP BY s.ref, i.amount_untaxed, c.rounding
+            HAVING abs(COALESCE(sum(l.price_subtotal), 0) -
+                       i.amount_untaxed) > c.rounding
+        """),
+        (_('Taxes do not add up to tax amount'), """
+            SELECT s.ref
+            FROM afip_import_invoice AS s
+            JOIN account_invoice AS i ON (i.id = s.id)
+            JOIN res_currency AS c ON (c.id = i.currency_id)
+            LEFT JOIN account_invoice_tax AS t ON (t.invoice_id = i.id)
+            GROUP BY s.ref, i.amount_tax, c.rounding
+            HAVING abs(COALESCE(sum(t.amount), 0) - i.amount_tax) > c.rounding
+        """),
+        (_('Untaxed and tax amounts do not add up to total'), """
+            SELECT s.ref
+            FROM afip_import_invoice AS s
+            JOIN account_invoice AS i ON (i.id = s.id)
+            JOIN res_currency AS c ON (c.id = i.currency_id)
+            WHERE abs(i.amount_untaxed + i.amount_tax - i.amount_total)
+                  > c.rounding
+        """),
+        (_('Number repeated in journal'), """
+            SELECT s.ref
+            FROM afip_import_invoice AS s
+            JOIN account_invoice AS i ON (i.id = s.id)
+            WHERE i.afip_doc_number > 0
+              AND (SELECT count(*) FROM afip_invoice_history AS o
+                   WHERE o.journal_id = i.journal_id
+                     AND o.afip_doc_number = i.afip_doc_number) > 1
+        """),
+    ]
+
+    @api.model
+    def _copy_file(self, kind, path):
+        """
+        Create the staging table of kind and COPY path into it.
+        """
+        table = 'afip_import_%s' % kind
+        known = dict(self._import_columns[kind])
+        self.env.cr.execute('DROP TABLE IF EXISTS %s' % table)
+        self.env.cr.execute('CREATE TEMP TABLE %s (%s) ON COMMIT DROP' % (
+            table, ', '.join('%s %s' % c for c in
+                             self._import_columns[kind] +
+                             self._resolved_columns[kind])))
+        if not path:
+            return
+
+        with open(path, 'rb') as f:
+            header = next(csv.reader(f))
+            unknown = [c for c in header if c not in known]
+            if unknown:
+                raise Warning(
+                    _('Wrong import file\n'
+                      'Unknown columns in %s: %s.') %
+                    (path, ', '.join(unknown)))
+            f.seek(0)
+            self.env.cr.copy_expert(
+                'COPY %s (%s) FROM STDIN WITH CSV HEADER' %
+                (table, ', '.join(header)), f)
+        self.env.cr.execute('ANALYZE %s' % table)
+
+    @api.model
+    def _resolve(self, company):
+        """
+        Fill database ids of the staged rows.
+        """
+        cr = self.env.cr
+        params = {'company': company.id, 'currency': company.currency_id.id}
+
+        cr.execute("""
+            UPDATE afip_import_invoice
+            SET type = COALESCE(NULLIF(type, ''), 'out_invoice'),
+                state = COALESCE(NULLIF(state, ''), 'paid'),
+                date_due = COALESCE(date_due, date_invoice),
+                id = nextval('account_invoice_id_seq')
+        """)
+
+        # Own vouchers go to the journal of their point of sale, supplier
+        # vouchers to any journal of their class, always of the journal type
+        # of the voucher type.
+        cr.execute("""
+            UPDATE afip_import_invoice AS s
+            SET journal_id = (
+                    SELECT j.id
+                    FROM account_journal AS j
+                    JOIN afip_journal_class AS jc
+                        ON (jc.id = j.journal_class_id)
+                    WHERE j.company_id = %(company)s
+                      AND jc.afip_code = s.afip_code
+                      AND j.type = CASE s.type
+                          WHEN 'out_invoice' THEN 'sale'
+                          WHEN 'out_refund' THEN 'sale_refund'
+                          WHEN 'in_invoice' THEN 'purchase'
+                          WHEN 'in_refund' THEN 'purchase_refund' END
+                      AND (j.point_of_sale = s.point_of_sale
+                           OR s.type IN ('in_invoice', 'in_refund'))
+                    ORDER BY j.point_of_sale = s.point_of_sale DESC,
+                             j.sequence, j.id
+                    LIMIT 1),
+                partner_id = (
+                    SELECT p.id FROM res_partner AS p
+                    WHERE p.document_number_normalized =
+                          regexp_replace(s.partner_document, '\\D', '', 'g')
+                      AND (p.company_id = %(company)s
+                           OR p.company_id IS NULL)
+                    ORDER BY p.parent_id IS NOT NULL, p.id
+                    LIMIT 1),
+                currency_id = COALESCE(
+                    (SELECT c.id FROM res_currency AS c
+                     WHERE c.name = s.currency),
+                    %(currency)s),
+                period_id = (
+                    SELECT p.id FROM account_period AS p
+                    WHERE p.company_id = %(company)s AND NOT p.special
+                      AND s.date_invoice BETWEEN p.date_start AND p.date_stop
+                    ORDER BY p.date_start
+                    LIMIT 1)
+        """, params)
+
+        # Factor from invoice currency to company currency at invoice date.
+        cr.execute("""
+            UPDATE afip_import_invoice AS s
+            SET rate = COALESCE((
+                    SELECT r.rate FROM res_currency_rate AS r
+                    WHERE r.currency_id = %(currency)s
+                      AND r.name <= s.date_invoice
+                    ORDER BY r.name DESC LIMIT 1), 1) /
+                COALESCE((
+                    SELECT r.rate FROM res_currency_rate AS r
+                    WHERE r.currency_id = s.currency_id
+                      AND r.name <= s.date_invoice
+                    ORDER BY r.name DESC LIMIT 1), 1)
+        """, params)
+
+        # Receivable and payable accounts are properties, read by partner.
+        cr.execute("""
+            SELECT DISTINCT partner_id, type IN ('out_invoice', 'out_refund')
+            FROM afip_import_invoice WHERE partner_id IS NOT NULL
+        """)
+        rows = cr.fetchall()
+        if rows:
+            partners = self.env['res.partner'].with_context(
+                force_company=company.id).browse(
+                    list(set(r[0] for r in rows)))
+            accounts = {}
+            for partner in partners:
+                accounts[partner.id, True] = \
+                    partner.property_account_receivable.id
+                accounts[partner.id, False] = \
+                    partner.property_account_payable.id
+            cr.execute("""
+                UPDATE afip_import_invoice AS s
+                SET account_id = v.account_id
+                FROM (SELECT unnest(%s::integer[]) AS partner_id,
+                             unnest(%s::boolean[]) AS customer,
+                             unnest(%s::integer[]) AS account_id) AS v
+                WHERE v.partner_id = s.partner_id
+                  AND v.customer = (s.type IN ('out_invoice', 'out_refund'))
+            """, ([r[0] for r in rows], [r[1] for r in rows],
+                  [accounts[r] or None for r in rows]))
+
+        cr.execute("""
+            UPDATE afip_import_line AS l
+            SET id = nextval('account_invoice_line_id_seq'),
+                invoice_id = s.id,
+                sequence = COALESCE(l.sequence, 10),
+                quantity = COALESCE(l.quantity, 1),
+                price_unit = COALESCE(
+                    l.price_unit,
+                    l.price_subtotal / NULLIF(COALESCE(l.quantity, 1), 0), 0),
+                discount = COALESCE(l.discount, 0),
+                price_subtotal = COALESCE(
+                    l.price_subtotal,
+                    round(COALESCE(l.quantity, 1) * l.price_unit *
+                          (1 - COALESCE(l.discount, 0) / 100), 2))
+            FROM afip_import_invoice AS s
+            WHERE s.ref = l.invoice_ref
+        """)
+        cr.execute("""
+            UPDATE afip_import_line AS l
+            SET product_id = pp.id, uos_id = pt.uom_id
+            FROM product_product AS pp
+            JOIN product_template AS pt ON (pt.id = pp.product_tmpl_id)
+            WHERE pp.default_code = l.product
+              AND (pt.company_id = %(company)s OR pt.company_id IS NULL)
+        """, params)
+        cr.execute("""
+            UPDATE afip_import_line AS l
+            SET account_id = a.id
+            FROM account_account AS a
+            WHERE a.code = l.account AND a.company_id = %(company)s
+        """, params)
+        cr.execute("""
+            UPDATE afip_import_line AS l
+            SET account_id = CASE WHEN s.type IN ('out_invoice', 'out_refund')
+                                  THEN j.default_credit_account_id
+                                  ELSE j.default_debit_account_id END
+            FROM afip_import_invoice AS s
+            JOIN account_journal AS j ON (j.id = s.journal_id)
+            WHERE s.id = l.invoice_id AND l.account_id IS NULL
+        """)
+
+        cr.execute("""
+            UPDATE afip_import_tax AS t
+            SET invoice_id = s.id
+            FROM afip_import_invoice AS s
+            WHERE s.ref = t.invoice_ref
+        """)
+        cr.execute("""
+            UPDATE afip_import_tax AS t
+            SET tax_id = x.id
+            FROM account_tax AS x
+            WHERE x.name = t.tax AND x.company_id = %(company)s
+        """, params)
+
+    @api.model
+    def _check(self, checks, params):
+        """
+        Run checks and raise listing the references at fault.
+        """
+        problems = []
+        for message, query in checks:
+            self.env.cr.execute(query, params)
+            refs = sorted(set(r[0] for r in self.env.cr.fetchall()))
+            if refs:
+                problems.append('%s: %s%s' % (
+                    _(message), ', '.join(refs[:_max_reported]),
+                    len(refs) > _max_reported and
+                    ' (+%i)' % (len(refs) - _max_reported) or ''))
+        if problems:
+            raise Warning(_('Import failed\n%s') % '\n'.join(problems))
+
+    @api.model
+    def _insert(self, company):
+        """
+        Write the staged rows in the invoice tables.
+        """
+        cr = self.env.cr
+        params = {'company': company.id, 'uid': self.env.uid,
+                  'now': fields.Datetime.now()}
+
+        cr.execute("""
+            INSERT INTO account_invoice (
+                id, create_uid, create_date, write_uid, write_date,
+                origin, type, state, sent, reference_type,
+                date_invoice, date_due, partner_id, commercial_partner_id,
+                account_id, journal_id, company_id, currency_id, period_id,
+                user_id, number, internal_number, supplier_invoice_number,
+                amount_untaxed, amount_tax, amount_total, check_total,
+                residual, reconciled,
+                afip_doc_number, afip_supplier_pos, afip_supplier_number,
+                afip_partner_document, afip_journal_class_code,
+                afip_cae, afip_cae_due)
+            SELECT s.id, %(uid)s, %(now)s, %(uid)s, %(now)s,
+                   s.ref, s.type, s.state, false, 'none',
+                   s.date_invoice, s.date_due, s.partner_id,
+                   COALESCE(p.commercial_partner_id, p.id),
+                   s.account_id, s.journal_id, %(company)s, s.currency_id,
+                   s.period_id, %(uid)s, v.number, v.number,
+                   CASE WHEN s.supplier THEN v.number END,
+                   s.amount_untaxed, s.amount_tax, s.amount_total,
+                   s.amount_total,
+                   CASE WHEN s.state = 'paid' THEN 0 ELSE s.amount_total END,
+                   s.state = 'paid',
+                   CASE WHEN NOT s.supplier THEN s.number ELSE 0 END,
+                   CASE WHEN s.supplier THEN s.point_of_sale ELSE 0 END,
+                   CASE WHEN s.supplier THEN s.number ELSE 0 END,
+                   p.document_number_normalized, s.afip_code,
+                   NULLIF(s.cae, ''), s.cae_due
+            FROM (SELECT *, type IN ('in_invoice', 'in_refund') AS supplier
+                  FROM afip_import_invoice) AS s
+            JOIN res_partner AS p ON (p.id = s.partner_id)
+            JOIN account_journal AS j ON (j.id = s.journal_id)
+            LEFT JOIN ir_sequence AS q ON (q.id = j.sequence_id)
+            CROSS JOIN LATERAL (SELECT CASE
+                WHEN s.supplier
+                THEN lpad(s.point_of_sale::text, 4, '0') || '-' ||
+                     lpad(s.number::text, 8, '0')
+                ELSE COALESCE(q.prefix, '') ||
+                     lpad(s.number::text, COALESCE(q.padding, 8), '0') ||
+                     COALESCE(q.suffix, '')
+                END AS number) AS v
+        """, params)
+        invoices = cr.rowcount
+
+        cr.execute("""
+            INSERT INTO account_invoice_line (
+                id, create_uid, create_date, write_uid, write_date,
+                invoice_id, sequence, name, product_id, uos_id, account_id,
+                quantity, price_unit, discount, price_subtotal,
+                company_id, partner_id)
+            SELECT l.id, %(uid)s, %(now)s, %(uid)s, %(now)s,
+                   l.invoice_id, l.sequence,
+                   COALESCE(NULLIF(l.name, ''), l.product, '/'),
+                   l.product_id, l.uos_id, l.account_id,
+                   l.quantity, l.price_unit, l.discount, l.price_subtotal,
+                   %(company)s, s.partner_id
+            FROM afip_import_line AS l
+            JOIN afip_import_invoice AS s ON (s.id = l.invoice_id)
+        """, params)
+        lines = cr.rowcount
+
+        cr.execute("""
+            INSERT INTO account_invoice_line_tax (invoice_line_id, tax_id)
+            SELECT DISTINCT l.id, x.id
+            FROM afip_import_line AS l,
+                 unnest(string_to_array(l.taxes, '|')) AS n(name)
+            JOIN account_tax AS x ON (x.name = n.name)
+            WHERE x.company_id = %(company)s
+        """, params)
+
+        # Company currency amounts carry the sign of the tax code, as
+        # account.invoice.tax computes them.
+        cr.execute("""
+            INSERT INTO account_invoice_tax (
+                create_uid, create_date, write_uid, write_date,
+                invoice_id, name, account_id, base, amount, manual, sequence,
+                base_code_id, tax_code_id, base_amount, tax_amount,
+                company_id)
+            SELECT %(uid)s, %(now)s, %(uid)s, %(now)s,
+                   t.invoice_id, x.name,
+                   COALESCE(CASE WHEN s.refund THEN x.account_paid_id
+                                 ELSE x.account_collected_id END,
+                            s.account_id),
+                   t.base, t.amount, false, x.sequence,
+                   CASE WHEN s.refund THEN x.ref_base_code_id
+                        ELSE x.base_code_id END,
+                   CASE WHEN s.refund THEN x.ref_tax_code_id
+                        ELSE x.tax_code_id END,
+                   round(t.base * s.rate * CASE WHEN s.refund
+                         THEN x.ref_base_sign ELSE x.base_sign END, 2),
+                   round(t.amount * s.rate * CASE WHEN s.refund
+                         THEN x.ref_tax_sign ELSE x.tax_sign END, 2),
+                   %(company)s
+            FROM afip_import_tax AS t
+            JOIN account_tax AS x ON (x.id = t.tax_id)
+            JOIN (SELECT *, type IN ('out_refund', 'in_refund') AS refund
+                  FROM afip_import_invoice) AS s ON (s.id = t.invoice_id)
+        """, params)
+        taxes = cr.rowcount
+
+        # Workflow instances standing at the activity of the imported state,
+        # as if the invoices had been validated.
+        cr.execute("""
+            WITH instance AS (
+                INSERT INTO wkf_instance (wkf_id, uid, res_id, res_type, state)
+                SELECT w.id, %(uid)s, s.id, w.osv,
+                       CASE WHEN s.state = 'paid' THEN 'complete'
+                            ELSE 'active' END
+                FROM afip_import_invoice AS s
+                JOIN wkf AS w ON (w.osv = 'account.invoice' AND w.on_create)
+                RETURNING id, res_id
+            )
+            INSERT INTO wkf_workitem (act_id, inst_id, state)
+            SELECT d.res_id, n.id, 'complete'
+            FROM instance AS n
+            JOIN afip_import_invoice AS s ON (s.id = n.res_id)
+            JOIN ir_model_data AS d ON (
+                d.module = 'account' AND d.model = 'workflow.activity'
+                AND d.name = 'act_' || s.state)
+        """, params)
+
+        cr.execute("SELECT id FROM afip_import_line")
+        self.env['account.invoice.line'].afip_backfill_prices(
+            line_ids=[r[0] for r in cr.fetchall()])
+
+        return {'invoices': invoices, 'lines': lines, 'taxes': taxes}
+
+    @api.model
+    def import_files(self, invoices_path, lines_path, taxes_path=None,
+                     company_id=None):
+        """
+        Import historical vouchers from CSV files. Return the number of
+        invoices, lines and tax lines imported.
+        """
+        company = self.env['res.company'].browse(company_id) \
+            if company_id else self.env.user.company_id
+        self._copy_file('invoice', invoices_path)
+        self._copy_file('line', lines_path)
+        self._copy_file('tax', taxes_path)
+
+        self._resolve(company)
+        self._check(self._staged_checks, {'company': company.id})
+        res = self._insert(company)
+        self._check(self._imported_checks, {'company': company.id})
+
+        self.env.cr.execute("""
+            SELECT count(*), COALESCE(sum(amount_total), 0)
+            FROM afip_import_invoice
+        """)
+        staged, staged_total = self.env.cr.fetchone()
+        self.env.cr.execute("""
+            SELECT count(*), COALESCE(sum(i.amount_total), 0)
+            FROM account_invoice AS i
+            JOIN afip_import_invoice AS s ON (s.id = i.id)
+        """)
+        if self.env.cr.fetchone() != (staged, staged_total):
+            raise Warning(_('Import failed\n'
+                            'Imported totals differ from the files.'))
+
+        self.env.invalidate_all()
+        _logger.info('Imported %(invoices)i invoices with %(lines)i lines'
+                     ' and %(taxes)i tax lines' % res)
+        return res
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+from openerp import api, models, fields, _
+from datetime import datetime, timedelta
+import logging
+import traceback
+
+_logger = logging.getLogger(__name__)
+
+# Minutes to wait before retrying a failed job, by attempt.
+_retry_delays = [1, 5, 15, 60, 240]
+
+
+class afip_invoice_job(models.Model):
+    """
+    Work to do after an invoice is opened, run by the cron workers.
+
+    Jobs of the same journal run in creation order, except jobs waiting
+    to be retried, which do not hold back the rest of their journal. Jobs
+    of different journals run by priority. Jobs failing max_attempts times
+    are left failed until retried by hand.
+    """
+    _name = 'afip.invoice_job'
+    _description = 'Invoice post-confirmation job'
+    _order = 'priority, id'
+
+    invoice_id = fields.Many2one('account.invoice', 'Invoice', required=True,
+                                 ondelete='cascade', select=True)
+    journal_id = fields.Many2one('account.journal', 'Journal', required=True,
+                                 select=True)
+    task = fields.Selection([('caea_report', 'Report CAEA voucher'),
+                             ('report', 'Print invoice'),
+                             ('mail', 'Send by email')], 'Task',
+                            required=True)
+    priority = fields.Integer('Priority', default=10,
+                              help='Lower numbers run first.')
+    state = fields.Selection([('pending', 'Pending'),
+                              ('done', 'Done'),
+                              ('failed', 'Failed')],
+                             'State', default='pending', required=True,
+                             select=True)
+    attempts = fields.Integer('Attempts', default=0)
+    max_attempts = fields.Integer('Max attempts', default=5)
+    eta = fields.Datetime('Not before')
+    date_done = fields.Datetime('Done at')
+    error = fields.Text('Last error')
+
+    @api.model
+    def _claim_next(self, cr):
+        """
+        Lock the next runnable job in cr. A job is runnable when no older
+        job of its journal is pending and due, so jobs locked by other
+        workers hold back the rest of their journal.
+        """
+        cr.execute("""
+            SELECT j.id
+            FROM afip_invoice_job AS j
+            WHERE j.state = 'pending'
+              AND (j.eta IS NULL OR j.eta <= (now() at time zone 'UTC'))
+              AND NOT EXISTS (
+                SELECT 1 FROM afip_invoice_job AS p
+                WHERE p.journal_id = j.journal_id
+                  AND p.state = 'pending'
+                  AND (p.eta IS NULL OR p.eta <= (now() at time zone 'UTC'))
+                  AND p.id < j.id)
+            ORDER BY j.priority, j.id
+            LIMIT 1
+            FOR UPDATE OF j SKIP LOCKED
+        """)
+        row = cr.fetchone()
+        return row and row[0]
+
+    @api.multi
+    def _run(self):
+        self.ensure_one()
+        invoice = self.invoice_id
+        try:
+            with self.env.cr.savepoint():
+                getattr(invoice, '_afip_job_%s' % self.task)()
+        except Exception:
+            self.env.invalidate_all()
+            attempts = self.attempts + 1
+            _logger.exception('Job %s of invoice %s failed (attempt %i)' %
+                              (self.task, invoice.id, attempts))
+            delay = _retry_delays[min(attempts, len(_retry_delays)) - 1]
+            self.write({
+                'attempts': attempts,
+                'state': attempts >= self.max_attempts and 'failed' or
+                'pending',
+                'eta': fields.Datetime.to_string(
+                    datetime.utcnow() + timedelta(minutes=delay)),
+                'error': traceback.format_exc(),
+            })
+            return False
+        self.write({'attempts': self.attempts + 1,
+                    'state': 'done',
+                    'date_done': fields.Datetime.now(),
+                    'error': False})
+        return True
+
+    @api.model
+    def run_jobs(self, limit=100):
+        """
+        Run up to limit jobs, each one in its own transaction.
+        Called by the cron; several crons can run it at the same time.
+        """
+        done = 0
+        for i in xrange(limit):
+            with self.pool.cursor() as cr:
+                env = api.Environment(cr, self.env.uid, self.env.context)
+                job_id = self._claim_next(cr)
+                if not job_id:
+                    break
+                env[self._name].browse(job_id)._run()
+                done += 1
+        return done
+
+    @api.multi
+    def action_retry(self):
+        self.write({'state': 'pending', 'attempts': 0, 'eta': False})
+        return True
+
+
+class account_invoice(models.Model):
+    _inherit = "account.invoice"
+
+    afip_job_ids = fields.One2many('afip.invoice_job', 'invoice_id',
+                                   'Post-confirmation jobs')
+
+    @api.model
+    def _afip_job_tasks(self):
+        """
+        Tasks to enqueue when an invoice is opened, with their priority.
+        Set in the l10n_ar_invoice.open_jobs parameter as a comma separated
+        list of task:priority.
+        """
+        param = self.env['ir.config_parameter'].get_param(
+            'l10n_ar_invoice.open_jobs', default='')
+        tasks = []
+        for item in param.split(','):
+            if not item.strip():
+                continue
+            task, sep, priority = item.strip().partition(':')
+            tasks.append((task, int(priority or 10)))
+        return tasks
+
+    @api.multi
+    def afip_enqueue_jobs(self):
+        """
+        Enqueue post-confirmation jobs. Called by the open activity.
+        """
+        job_obj = self.env['afip.invoice_job']
+        tasks = self._afip_job_tasks()
+        for invoice in self:
+            for task, priority in tasks:
+                job_obj.create({'invoice_id': invoice.id,
+                                'journal_id': invoice.journal_id.id,
+                                'task': task,
+                                'priority': priority})
+        return True
+
+    @api.multi
+    def _afip_job_caea_report(self):
+        """
+        Report the voucher to AFIP if it was numbered with a CAEA and is
+        still to report.
+        """
+        if self.afip_caea_state != 'pending':
+            return
+        caea = self.afip_caea_id
+        caea._report_batch(caea._service(), self.journal_id, self)
+
+    @api.multi
+    def _afip_job_report(self):
+        """
+        Render the invoice report. The report stores its attachment.
+        """
+        self.env['report'].get_pdf(self, 'account.report_invoice')
+
+    @api.multi
+    def _afip_job_mail(self):
+        """
+        Send the invoice to the partner with the invoice email template.
+        """
+        template = self.env.ref('account.email_template_edi_invoice')
+        self.env['email.template'].send_mail(template.id, self.id)
+        self.write({'sent': True})
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
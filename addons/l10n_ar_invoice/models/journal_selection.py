@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+from openerp import api, models, _
+from openerp.exceptions import Warning
+from .chunked import iter_chunks, DEFAULT_CHUNK_SIZE
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Journal class types by invoice type.
+_journal_type = {
+    'out_invoice': 'sale',
+    'out_refund': 'sale_refund',
+    'in_invoice': 'purchase',
+    'in_refund': 'purchase_refund',
+}
+
+# AFIP codes of export journal classes.
+_export_codes = (19, 20, 21)
+
+
+class account_invoice(models.Model):
+    """
+    Choose journals for invoices from responsabilities, invoice type,
+    export flag, point of sale and product types.
+    """
+    _inherit = "account.invoice"
+
+    @api.model
+    def _afip_journal_table(self, company_ids):
+        """
+        Journals by company and journal class, in sequence order.
+        """
+        res = {}
+        for journal in self.env['account.journal'].search_read(
+                [('company_id', 'in', list(company_ids)),
+                 ('journal_class_id', '!=', False)],
+                ['company_id', 'journal_class_id', 'point_of_sale'],
+                order='sequence, id'):
+            res.setdefault(
+                (journal['company_id'][0], journal['journal_class_id'][0]),
+                []).append((journal['id'], journal['point_of_sale']))
+        return res
+
+    @api.model
+    def _afip_resolve_journal(self, journals, company_id, issuer_id,
+                              receptor_id, inv_type, for_export,
+                              point_of_sale, product_types):
+        """
+        First journal accepting an invoice with these properties.
+        """
+        class_obj = self.env['afip.journal_class']
+        document_classes = self.env['afip.responsability_relation'] \
+            ._get_classes_by_responsabilities().get(
+                (issuer_id, receptor_id), ())
+        for jc_id, jc in class_obj._get_class_table().items():
+            if jc['type'] != _journal_type[inv_type] or \
+                    jc['document_class_id'] not in document_classes or \
+                    (jc['afip_code'] in _export_codes) != bool(for_export) or \
+                    not class_obj.accepts_products(jc_id, product_types):
+                continue
+            for journal_id, pos in journals.get((company_id, jc_id), ()):
+                if not point_of_sale or pos == point_of_sale:
+                    return journal_id
+        return False
+
+    @api.multi
+    def afip_select_journals(self, point_of_sale=None, for_export=None,
+                             chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Set the journal of each invoice. Invoices with equal properties
+        share one resolution and one write by chunk of invoices.
+
+        When for_export is None, invoices to foreign partners are taken as
+        export invoices.
+        """
+        journals = self._afip_journal_table(set(self.mapped('company_id.id')))
+        resolved = {}
+        res = {}
+        for chunk in iter_chunks(self, chunk_size):
+            res.update(self._afip_select_chunk_journals(
+                chunk, journals, resolved, point_of_sale, for_export))
+        return res
+
+    @api.model
+    def _afip_select_chunk_journals(self, invoices, journals, resolved,
+                                    point_of_sale, for_export):
+        """
+        Set the journal of invoices, sharing resolved between chunks.
+        """
+        to_write = {}
+        for inv in invoices:
+            if inv.type in ('out_invoice', 'out_refund'):
+                issuer = inv.company_id.partner_id
+                receptor = inv.partner_id
+            else:
+                issuer = inv.partner_id
+                receptor = inv.company_id.partner_id
+            export = for_export if for_export is not None else \
+                inv.partner_id.responsability_id.code == 'EXT'
+            key = (inv.company_id.id,
+                   issuer.responsability_id.id,
+                   receptor.responsability_id.id,
+                   inv.type, export, point_of_sale,
+                   frozenset(inv.invoice_line.mapped('product_id.type')))
+            if key not in resolved:
+                resolved[key] = self._afip_resolve_journal(journals, *key)
+            if not resolved[key]:
+                raise Warning(
+                    _('No journal found\n'
+                      'There is no journal for invoices from %s to %s with'
+                      ' these products.') % (issuer.name, receptor.name))
+            if inv.journal_id.id != resolved[key]:
+                to_write.setdefault(resolved[key], []).append(inv.id)
+
+        for journal_id, ids in to_write.items():
+            self.browse(ids).write({'journal_id': journal_id})
+        return dict((inv.id, inv.journal_id.id) for inv in invoices)
+
+    @api.multi
+    def _afip_test_product_types(self):
+        """
+        Test journal classes accept the products of the invoice
+        """
+        class_obj = self.env['afip.journal_class']
+        for invoice in self:
+            # Lines without product type are checked by _afip_test_lines.
+            product_types = set(invoice.invoice_line.mapped(
+                'product_id.type')) - set([False])
+            if not class_obj.accepts_products(
+                    invoice.journal_id.journal_class_id.id, product_types):
+                raise Warning(
+                    _('Wrong Journal\n'
+                      'Journal %s only accepts products of types %s.') %
+                    (invoice.journal_id.name,
+                     invoice.journal_id.journal_class_id.product_types))
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+from openerp import api, models, fields, _
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+class afip_numbering_checkpoint(models.Model):
+    """
+    Last document number audited by journal.
+    """
+    _name = 'afip.numbering_checkpoint'
+    _description = 'AFIP numbering audit checkpoint'
+    _rec_name = 'journal_id'
+
+    journal_id = fields.Many2one('account.journal', 'Journal', required=True,
+                                 ondelete='cascade')
+    last_number = fields.Integer('Last audited number')
+    last_date = fields.Date('Date of last audited number')
+    date_audit = fields.Datetime('Last audit')
+
+    _sql_constraints = [('journal_id', 'unique(journal_id)',
+                         'One checkpoint by journal!')]
+
+    @api.model
+    def run_audit(self, journal_ids=None):
+        """
+        Find gaps, duplicated numbers and dates out of order in journals
+        since their last checkpoint. Return the number of issues found.
+        """
+        if journal_ids is None:
+            journal_ids = self.env['account.journal'].search(
+                [('journal_class_id', '!=', False)]).ids
+        if not journal_ids:
+            return 0
+        now = fields.Datetime.now()
+
+        # Invoices are scanned from the last audited number, so the first
+        # one scanned is compared with the end of the previous audit.
+        # Archived invoices are scanned too, but can not be linked to issues.
+        self.env.cr.execute("""
+            WITH scan AS (
+                SELECT CASE WHEN i.archive_year IS NULL THEN i.id END AS id,
+                       i.journal_id, i.afip_doc_number AS num,
+                       i.date_invoice,
+                       COALESCE(lag(i.afip_doc_number) OVER w,
+                                c.last_number, 0) AS prev_num,
+                       lag(i.date_invoice) OVER w AS prev_date,
+                       lag(i.journal_id) OVER w AS prev_journal
+                FROM afip_invoice_history AS i
+                LEFT JOIN afip_numbering_checkpoint AS c
+                    ON (c.journal_id = i.journal_id)
+                WHERE i.journal_id IN %(journals)s
+                  AND i.afip_doc_number > 0
+                  AND i.state NOT IN ('draft', 'cancel')
+                  AND i.afip_doc_number >= COALESCE(c.last_number, 0)
+                WINDOW w AS (PARTITION BY i.journal_id
+                             ORDER BY i.afip_doc_number, i.id)
+            ), found AS (
+                SELECT journal_id, 'gap' AS kind, prev_num + 1 AS number,
+                       num - 1 AS number_to, id AS invoice_id
+                FROM scan WHERE num > prev_num + 1
+                UNION ALL
+                SELECT journal_id, 'duplicate', num, num, id
+                FROM scan WHERE num = prev_num AND prev_journal IS NOT NULL
+                UNION ALL
+                SELECT journal_id, 'date', num, num, id
+                FROM scan WHERE date_invoice < prev_date
+            )
+            INSERT INTO afip_numbering_issue
+                (create_uid, create_date, write_uid, write_date,
+                 journal_id, point_of_sale, kind, number, number_to,
+                 invoice_id, date_found, solved)
+            SELECT %(uid)s, %(now)s, %(uid)s, %(now)s,
+                   f.journal_id, j.point_of_sale, f.kind, f.number,
+                   f.number_to, f.invoice_id, %(now)s, false
+            FROM found AS f
+            JOIN account_journal AS j ON (j.id = f.journal_id)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM afip_numbering_issue AS o
+                WHERE o.journal_id = f.journal_id
+                  AND o.kind = f.kind
+                  AND o.number = f.number
+                  AND o.invoice_id IS NOT DISTINCT FROM f.invoice_id)
+        """, {'journals': tuple(journal_ids), 'uid': self.env.uid,
+              'now': now})
+        count = self.env.cr.rowcount
+
+        self.env.cr.execute("""
+            SELECT DISTINCT ON (journal_id)
+                   journal_id, afip_doc_number, date_invoice
+            FROM afip_invoice_history
+            WHERE journal_id IN %s AND afip_doc_number > 0
+              AND state NOT IN ('draft', 'cancel')
+            ORDER BY journal_id, afip_doc_number DESC
+        """, (tuple(journal_ids),))
+        last = dict((r[0], r[1:]) for r in self.env.cr.fetchall())
+
+        checkpoints = dict((c.journal_id.id, c) for c in self.search(
+            [('journal_id', 'in', journal_ids)]))
+        for journal_id in journal_ids:
+            number, date = last.get(journal_id, (0, False))
+            vals = {'last_number': number, 'last_date': date,
+                    'date_audit': now}
+            if journal_id in checkpoints:
+                checkpoints[journal_id].write(vals)
+            else:
+                vals['journal_id'] = journal_id
+                self.create(vals)
+
+        self.env['afip.numbering_issue'].invalidate_cache()
+        _logger.info('Numbering audit found %i issues in %i journals' %
+                     (count, len(journal_ids)))
+        return count
+
+    @api.model
+    def action_run_audit(self):
+        self.run_audit()
+        action = self.env.ref('l10n_ar_invoice.act_afip_numbering_issue')
+        return action.read()[0]
+
+
+class afip_numbering_issue(models.Model):
+    """
+    Gap, duplicated number or date out of order found by the audit.
+    """
+    _name = 'afip.numbering_issue'
+    _description = 'AFIP numbering issue'
+    _order = 'point_of_sale, journal_id, number'
+    _rec_name = 'number'
+
+    journal_id = fields.Many2one('account.journal', 'Journal', required=True,
+                                 ondelete='cascade', select=True)
+    point_of_sale = fields.Integer(related='journal_id.point_of_sale',
+                                   store=True, string='Point of sale')
+    kind = fields.Selection([('gap', 'Missing numbers'),
+                             ('duplicate', 'Repeated number'),
+                             ('date', 'Date before previous number')],
+                            'Issue', required=True)
+    number = fields.Integer('Number')
+    number_to = fields.Integer('Up to number')
+    invoice_id = fields.Many2one('account.invoice', 'Invoice',
+                                 ondelete='cascade')
+    date_found = fields.Datetime('Found at')
+    solved = fields.Boolean('Solved', default=False)
+
+    @api.model
+    def audit_report(self):
+        """
+        Open issues by point of sale and kind.
+        """
+        res = {}
+        for group in self.read_group([('solved', '=', False)],
+                                     ['point_of_sale', 'kind'],
+                                     ['point_of_sale', 'kind'], lazy=False):
+            res.setdefault(group['point_of_sale'], {})[group['kind']] = \
+                group['__count']
+        return res
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
@@ -1,7 +1,20 @@
 # -*- coding: utf-8 -*-
-from openerp import fields, models
+from openerp import api, fields, models, tools
 from openerp.tools.translate import _
 import re
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Characters found in typed document numbers.
+re_not_document = re.compile(r'[^\d\s.\-/]')
+
+
+def normalize_document(document_number):
+    """
+    Digits of a document number, as 20123456789 for 20-12345678-9.
+    """
+    return re.sub(r'\D', '', document_number or '') or False
 
 
 class res_partner(models.Model):
@@ -21,6 +34,12 @@ class res_partner(models.Model):
             size=64, select=1,
             on_change="onchange_document(vat,document_type_id,document_number)"
         )
+    document_number_normalized=fields.Char(
+            'Normalized document number',
+            compute='_get_document_number_normalized', store=True,
+            size=64, select=1,
+            help='Document number digits only, used to look up partners.'
+        )
     iibb=fields.Char('Ingresos Brutos', size=64)
     start_date=fields.Date('Inicio de actividades')
     afip_destination_id = fields.Many2one(
@@ -28,6 +47,44 @@ class res_partner(models.Model):
         'Export Destionation'
     )
 
+    @api.multi
+    @api.depends('document_number')
+    def _get_document_number_normalized(self):
+        for partner in self:
+            partner.document_number_normalized = \
+                normalize_document(partner.document_number)
+
+    @api.model
+    def name_search(self, name='', args=None, operator='ilike', limit=100):
+        """
+        Search by document number when name looks like one.
+        """
+        digits = normalize_document(name)
+        if digits and len(digits) > 6 and not re_not_document.search(name):
+            partners = self.search(
+                [('document_number_normalized', '=like', digits + '%')] +
+                (args or []), limit=limit)
+            if partners:
+                return partners.name_get()
+        return super(res_partner, self).name_search(
+            name=name, args=args, operator=operator, limit=limit)
+
+    @api.model
+    def afip_find_by_document(self, document_numbers):
+        """
+        Return a map from normalized document number to partner ids.
+        """
+        numbers = list(set(filter(None, map(normalize_document,
+                                              document_numbers))))
+        res = {}
+        if numbers:
+            for partner in self.search_read(
+                    [('document_number_normalized', 'in', numbers)],
+                    ['document_number_normalized']):
+                res.setdefault(partner['document_number_normalized'],
+                               []).append(partner['id'])
+        return res
+
     def onchange_document(self, cr, uid, ids, vat, document_type,
                           document_number, context={}):
         v = {}
@@ -103,6 +160,67 @@ class res_partner(models.Model):
                                'vat', 'is_vat_subject']):
             pass
 
+    @api.multi
+    def _afip_get_destination(self):
+        """
+        Return the export destination of the partner, taken from the
+        partner or resolved from its country and state.
+        """
+        self.ensure_one()
+        return self.afip_destination_id or self.env['afip.destination'].browse(
+            self.env['afip.destination'].resolve(self.country_id.id,
+                                                 self.state_id.id))
+
+    @api.model
+    def afip_fill_destinations(self, domain=None):
+        """
+        Set export destination of foreign partners without one, and their
+        document number to the AFIP generic CUIT of the destination.
+        """
+        dest_obj = self.env['afip.destination']
+        domain = (domain or []) + [
+            ('afip_destination_id', '=', False),
+            ('country_id', '!=', False),
+            ('country_id.code', '!=', 'AR'),
+        ]
+        partners = self.with_context(active_test=False).search_read(
+            domain, ['country_id', 'state_id', 'is_company',
+                     'document_number'])
+
+        # Group partners receiving the same values to write them together.
+        to_write = {}
+        for partner in partners:
+            dest_id = dest_obj.resolve(
+                partner['country_id'] and partner['country_id'][0],
+                partner['state_id'] and partner['state_id'][0])
+            if not dest_id:
+                continue
+            # Partners with a document number keep it.
+            kind = not partner['document_number'] and \
+                (partner['is_company'] and 'company' or 'person')
+            to_write.setdefault((dest_id, kind), []).append(partner['id'])
+
+        if not to_write:
+            return 0
+
+        cuits = dict((d['id'], d) for d in dest_obj.search_read(
+            [('id', 'in', list(set(k[0] for k in to_write)))],
+            ['afip_cuit_person', 'afip_cuit_company']))
+        cuit_type = self.env.ref('l10n_ar_invoice.dt_CUIT')
+
+        count = 0
+        for (dest_id, kind), ids in to_write.items():
+            vals = {'afip_destination_id': dest_id}
+            cuit = kind and cuits[dest_id]['afip_cuit_%s' % kind]
+            if cuit:
+                vals.update({'document_number': cuit,
+                             'document_type_id': cuit_type.id})
+            self.browse(ids).write(vals)
+            count += len(ids)
+
+        _logger.info('Export destination set to %i partners' % count)
+        return count
+
     def prefered_journals(self, cr, uid, ids, type, context=None):
         """
         Devuelve la lista de journals disponibles para este partner.
@@ -136,16 +254,19 @@ class res_partner(models.Model):
             'in_refund': ['purchase_refund'],
         }
 
-        for partner in self.browse(cr, uid, ids):
-            partner_id = partner.id
-            partner = partner_pool.browse(cr, uid, partner_id)
-
+        # Partners sharing a responsability share their journals, so
+        # journal classes are searched once by responsability.
+        by_responsability = {}
+        for partner in self.browse(cr, uid, ids, context=context):
             if not partner.responsability_id:
                 raise Warning(
                     _('Error!\n'
                       'This partner has not setted any responsability')
                 )
+            by_responsability.setdefault(partner.responsability_id.id,
+                                         []).append(partner.id)
 
+        for responsability_id, partner_ids in by_responsability.items():
             journal_data = journal_class_pool.search_read(
                 cr, uid, [
                     ('type', 'in', type_map[type]),
@@ -154,16 +275,57 @@ class res_partner(models.Model):
                      company.partner_id.responsability_id.id),
                     ('document_class_id.responsability_relation_ids'
                      '.receptor_id', '=',
-                     partner.responsability_id.id),
+                     responsability_id),
                 ], ['journal_ids'], order="sequence asc")
 
             journal_ids = reduce(lambda a, b: a + b,
-                                 [jc['journal_ids'] for jc in journal_data])
+                                 [jc['journal_ids'] for jc in journal_data],
+                                 [])
 
-            result[partner_id] = journal_ids
+            for partner_id in partner_ids:
+                result[partner_id] = journal_ids
 
         return result
 
 res_partner()
 
+
+class afip_partner_duplicate(models.Model):
+    """
+    Partners sharing a normalized document number.
+    """
+    _name = 'afip.partner_duplicate'
+    _description = 'Partners with repeated document number'
+    _auto = False
+    _order = 'document_number, partner_id'
+
+    partner_id = fields.Many2one('res.partner', 'Partner', readonly=True)
+    document_number = fields.Char('Document number', readonly=True)
+    document_type_id = fields.Many2one('afip.document_type',
+                                       'Document type', readonly=True)
+    partner_count = fields.Integer('Partners with this number',
+                                   readonly=True)
+
+    def init(self, cr):
+        tools.drop_view_if_exists(cr, self._table)
+        cr.execute("""
+            CREATE VIEW afip_partner_duplicate AS (
+                SELECT id, partner_id, document_number, document_type_id,
+                       partner_count
+                FROM (
+                    SELECT p.id AS id,
+                           p.id AS partner_id,
+                           p.document_number_normalized AS document_number,
+                           p.document_type_id AS document_type_id,
+                           count(*) OVER (
+                             PARTITION BY p.document_number_normalized
+                           ) AS partner_count
+                    FROM res_partner AS p
+                    WHERE p.document_number_normalized IS NOT NULL
+                      AND p.active
+                ) AS d
+                WHERE partner_count > 1
+            )
+        """)
+
 # vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
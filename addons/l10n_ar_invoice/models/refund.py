@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+from openerp import api, models, fields, _
+from openerp.exceptions import Warning
+from .chunked import iter_chunks
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# AFIP code of the credit note class of each invoice or debit note class.
+_refund_codes = {
+    1: 3, 2: 3,
+    6: 8, 7: 8,
+    11: 13, 12: 13,
+    51: 53, 52: 53,
+    19: 21, 20: 21,
+}
+
+# Journal class type of credit notes by journal class type of invoices.
+_refund_journal_type = {
+    'sale': 'sale_refund',
+    'purchase': 'purchase_refund',
+}
+
+
+class account_invoice(models.Model):
+    """
+    Refund many invoices at once into their AFIP credit note journals.
+    """
+    _inherit = "account.invoice"
+
+    @api.model
+    def _afip_refund_journal_table(self, company_ids):
+        """
+        Credit note journal of each invoice journal: one of the matching
+        credit note class, preferring the same point of sale.
+        """
+        classes = self.env['afip.journal_class']._get_class_table()
+        journals = self._afip_journal_table(company_ids)
+        by_code = {}
+        for jc_id, jc in classes.items():
+            by_code.setdefault((jc['type'], jc['afip_code']), []).append(jc_id)
+
+        res = {}
+        for (company_id, jc_id), invoice_journals in journals.items():
+            jc = classes.get(jc_id)
+            if not jc or jc['afip_code'] not in _refund_codes:
+                continue
+            refund_journals = []
+            for refund_class_id in by_code.get(
+                    (_refund_journal_type.get(jc['type']),
+                     _refund_codes[jc['afip_code']]), ()):
+                refund_journals.extend(
+                    journals.get((company_id, refund_class_id), ()))
+            if not refund_journals:
+                continue
+            for journal_id, pos in invoice_journals:
+                same_pos = [j for j, p in refund_journals if p == pos]
+                res[journal_id] = same_pos[0] if same_pos else \
+                    refund_journals[0][0]
+        return res
+
+    @api.multi
+    def afip_bulk_refund(self, date=None, description=None, validate=True,
+                         batch_size=100):
+        """
+        Create credit notes of open or paid invoices in the credit note
+        journal matching each invoice journal, batch_size invoices by call
+        to refund. Credit notes are checked together and validated when
+        asked. Return the credit notes.
+        """
+        invoices = self.filtered(
+            lambda inv: inv.type in ('out_invoice', 'in_invoice') and
+            inv.state in ('open', 'paid'))
+        wrong = self - invoices
+        if wrong:
+            raise Warning(
+                _('Invoices can not be refunded\n'
+                  'Only open or paid invoices, not credit notes, can be'
+                  ' refunded: %s.') %
+                ', '.join(inv.number or inv.name or str(inv.id)
+                          for inv in wrong))
+        table = self._afip_refund_journal_table(
+            set(invoices.mapped('company_id').ids))
+        missing = invoices.filtered(lambda inv: inv.journal_id.id not in table)
+        if missing:
+            raise Warning(
+                _('No credit note journal\n'
+                  'There is no credit note journal for journals %s.') %
+                ', '.join(sorted(set(missing.mapped('journal_id.name')))))
+
+        by_journal = {}
+        for inv in invoices:
+            by_journal.setdefault(table[inv.journal_id.id], []).append(inv.id)
+        period_id = date and self.env['account.period'].find(date)[:1].id \
+            or None
+
+        refund_ids = []
+        for journal_id, ids in sorted(by_journal.items()):
+            for chunk in iter_chunks(self.browse(ids), batch_size):
+                refund_ids.extend(chunk.refund(
+                    date, period_id, description, journal_id).ids)
+
+        refunds = self.browse(refund_ids)
+        refunds.afip_validation()
+        if validate:
+            refunds.signal_workflow('invoice_open')
+        _logger.info('Created %i credit notes in %i journals' %
+                     (len(refunds), len(by_journal)))
+        return refunds
+
+
+class afip_refund_wizard(models.TransientModel):
+    """
+    Refund the selected invoices.
+    """
+    _name = 'afip.refund_wizard'
+    _description = 'AFIP bulk refund'
+
+    date = fields.Date('Date', default=fields.Date.context_today)
+    description = fields.Char('Reason', required=True)
+    validate = fields.Boolean('Validate credit notes', default=True)
+
+    @api.multi
+    def action_refund(self):
+        self.ensure_one()
+        invoices = self.env['account.invoice'].browse(
+            self.env.context.get('active_ids', []))
+        refunds = invoices.afip_bulk_refund(
+            date=self.date, description=self.description,
+            validate=self.validate)
+        return {
+            'type': 'ir.actions.act_window',
+            'name': _('Credit notes'),
+            'res_model': 'account.invoice',
+            'view_type': 'form',
+            'view_mode': 'tree,form',
+            'domain': [('id', 'in', refunds.ids)],
+        }
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
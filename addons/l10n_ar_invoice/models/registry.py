@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+from openerp import api, models, fields, tools, _
+from openerp.exceptions import Warning
+from .sorted_index import build_index, open_index
+from .partner import normalize_document
+import os
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+def _registry_date(value):
+    """
+    Registry files give dates as ddmmyyyy.
+    """
+    value = (value or '').strip()
+    if len(value) != 8 or not value.isdigit():
+        return False
+    return '%s-%s-%s' % (value[4:], value[2:4], value[:2])
+
+
+class afip_registry(models.Model):
+    """
+    Registry published by a tax agency, keyed by CUIT, with one index file
+    by period.
+
+    Registry files are text with one CUIT by line and columns separated
+    by a delimiter, as the ARBA perception registry:
+
+        P;25102015;01112015;30112015;20000000028;D;N;N;1,00;00;
+
+    or of fixed width, as the AFIP tax status registry.
+    """
+    _name = 'afip.registry'
+    _description = 'Tax agency registry'
+
+    name = fields.Char('Name', required=True)
+    code = fields.Char('Code', required=True,
+                       help="Used to name the index files.")
+    kind = fields.Selection([('iibb', 'Gross income tax rates'),
+                             ('tax_status', 'AFIP tax status')],
+                            'Kind', required=True, default='iibb')
+    company_id = fields.Many2one(
+        'res.company', 'Company', required=True,
+        default=lambda self: self.env.user.company_id)
+    tax_id = fields.Many2one(
+        'account.tax', 'Perception tax',
+        domain=[('type_tax_use', 'in', ('sale', 'all'))],
+        help="Tax of the perception lines added to sale invoices.")
+    delimiter = fields.Char('Delimiter', size=1, default=';',
+                            help="Leave empty for fixed width files.")
+    cuit_column = fields.Integer('CUIT column', required=True, default=4,
+                                 help="Columns are counted from 0.")
+    rate_column = fields.Integer('Rate column', default=8)
+    date_from_column = fields.Integer('Valid from column', default=2)
+    date_to_column = fields.Integer('Valid to column', default=3)
+    status_column = fields.Integer('VAT status column', default=3)
+    category_column = fields.Integer('Monotributo category column',
+                                     default=4)
+    period_ids = fields.One2many('afip.registry_period', 'registry_id',
+                                 'Periods')
+
+    _sql_constraints = [('code', 'unique(code)', 'Code must be unique!')]
+
+    # Index record format by kind.
+    _values_format = {
+        'iibb': 'I',
+        'tax_status': '2s2s',
+    }
+
+    # Column widths of fixed width files by kind: CUIT, name, income tax,
+    # VAT, monotributo, partner of company, employer, monotributo activity.
+    _fixed_widths = {
+        'tax_status': (11, 30, 2, 2, 2, 1, 1, 2),
+    }
+
+    @api.onchange('kind')
+    def _onchange_kind(self):
+        if self.kind == 'tax_status':
+            self.delimiter = False
+            self.cuit_column = 0
+        else:
+            self.delimiter = ';'
+            self.cuit_column = 4
+
+    @api.model
+    def _storage_dir(self):
+        path = os.path.join(tools.config['data_dir'], 'afip_registry',
+                            self.env.cr.dbname)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return path
+
+    @api.multi
+    def _row_parser(self):
+        """
+        Function returning the index values from the columns of a line.
+        """
+        if self.kind == 'tax_status':
+            status_column = self.status_column
+            category_column = self.category_column
+
+            def parse_status(columns):
+                return (columns[status_column].strip(),
+                        columns[category_column].strip())
+            return parse_status
+
+        rate_column = self.rate_column
+
+        def parse(columns):
+            # Rates are kept in hundredths of percent.
+            return (int(round(float(
+                columns[rate_column].replace(',', '.')) * 100)),)
+        return parse
+
+    @api.multi
+    def _line_splitter(self):
+        """
+        Function splitting a line in columns.
+        """
+        if self.delimiter:
+            delimiter = self.delimiter
+            return lambda line: line.split(delimiter)
+
+        bounds = []
+        start = 0
+        for width in self._fixed_widths.get(self.kind, ()):
+            bounds.append((start, start + width))
+            start += width
+        return lambda line: [line[a:b] for a, b in bounds]
+
+    @api.multi
+    def _parse_rows(self, path, dates):
+        """
+        Yield (CUIT, values...) of each line of path and keep in dates the
+        period of the first line.
+        """
+        parse = self._row_parser()
+        split = self._line_splitter()
+        cuit_column = self.cuit_column
+        date_from_column = self.date_from_column
+        date_to_column = self.date_to_column
+        with open(path, 'rb') as f:
+            for line in f:
+                columns = split(line.rstrip('\r\n'))
+                if len(columns) <= cuit_column:
+                    continue
+                cuit = normalize_document(columns[cuit_column])
+                if not cuit:
+                    continue
+                if not dates and len(columns) > max(date_from_column,
+                                                    date_to_column):
+                    dates['date_from'] = _registry_date(
+                        columns[date_from_column])
+                    dates['date_to'] = _registry_date(
+                        columns[date_to_column])
+                yield (int(cuit),) + parse(columns)
+
+    @api.multi
+    def load_file(self, path, date_from=None, date_to=None):
+        """
+        Build the index of a published registry file and make it the one
+        of its period. The period is taken from the file when not given.
+        """
+        self.ensure_one()
+        dates = {}
+        tmp_path = os.path.join(self._storage_dir(),
+                                '%s-loading-%s.idx' % (self.code, os.getpid()))
+        count = build_index(tmp_path, self._parse_rows(path, dates),
+                            self._values_format[self.kind])
+        date_from = date_from or dates.get('date_from')
+        date_to = date_to or dates.get('date_to') or False
+        if not date_from:
+            os.unlink(tmp_path)
+            raise Warning(_('Wrong registry file\n'
+                            'Can not find the period of %s.') % path)
+
+        filename = '%s-%s.idx' % (self.code, date_from.replace('-', ''))
+        # Readers keep the previous file until the rename.
+        os.rename(tmp_path, os.path.join(self._storage_dir(), filename))
+
+        vals = {'date_to': date_to, 'filename': filename, 'rows': count,
+                'date_loaded': fields.Datetime.now()}
+        period = self.period_ids.filtered(lambda p: p.date_from == date_from)
+        if period:
+            period.write(vals)
+        else:
+            vals.update(registry_id=self.id, date_from=date_from)
+            period = period.create(vals)
+        _logger.info('Registry %s loaded for %s with %i rows' %
+                     (self.code, date_from, count))
+        return period
+
+    @api.multi
+    def _get_index(self, date):
+        """
+        Index of the period including date, or None.
+        """
+        self.ensure_one()
+        period = self.env['afip.registry_period'].search(
+            [('registry_id', '=', self.id), ('date_from', '<=', date),
+             '|', ('date_to', '=', False), ('date_to', '>=', date)],
+            order='date_from desc', limit=1)
+        if not period:
+            return None
+        path = os.path.join(self._storage_dir(), period.filename)
+        if not os.path.exists(path):
+            _logger.warning('Registry %s index %s not found' %
+                            (self.code, path))
+            return None
+        return open_index(path)
+
+    @api.multi
+    def lookup(self, cuits, date=None):
+        """
+        Values in the registry of each CUIT at date, by CUIT.
+        """
+        index = self._get_index(date or fields.Date.context_today(self))
+        if index is None:
+            return {}
+        keys = dict((int(c), c) for c in cuits if c)
+        return dict((keys[k], v) for k, v in index.get_many(keys).items())
+
+    @api.multi
+    def get_rates(self, cuits, date=None):
+        """
+        Percent rate of each CUIT found at date, by CUIT.
+        """
+        return dict((cuit, values[0] / 100.0)
+                    for cuit, values in self.lookup(cuits, date).items())
+
+
+class afip_registry_period(models.Model):
+    """
+    Index file of a registry for a period.
+    """
+    _name = 'afip.registry_period'
+    _description = 'Tax agency registry period'
+    _order = 'registry_id, date_from desc'
+    _rec_name = 'date_from'
+
+    registry_id = fields.Many2one('afip.registry', 'Registry', required=True,
+                                  ondelete='cascade')
+    date_from = fields.Date('Valid from', required=True)
+    date_to = fields.Date('Valid to')
+    filename = fields.Char('Index file', readonly=True)
+    rows = fields.Integer('Rows', readonly=True)
+    date_loaded = fields.Datetime('Loaded at', readonly=True)
+
+    _sql_constraints = [('period', 'unique(registry_id, date_from)',
+                         'One index by registry and period!')]
+
+
+class account_invoice(models.Model):
+    _inherit = "account.invoice"
+
+    @api.multi
+    def _afip_registry_key(self):
+        """
+        CUIT of the partner to look for in registries.
+        """
+        self.ensure_one()
+        partner = self.commercial_partner_id or self.partner_id
+        iibb = normalize_document(partner.iibb)
+        if iibb and len(iibb) == 11:
+            return iibb
+        return partner.document_number_normalized
+
+    @api.multi
+    def afip_add_perceptions(self):
+        """
+        Add a gross income perception line to draft sale invoices from
+        the registries of their companies. Return the rate applied by
+        invoice.
+        """
+        invoices = self.filtered(
+            lambda inv: inv.state == 'draft' and
+            inv.type in ('out_invoice', 'out_refund'))
+        registries = self.env['afip.registry'].search(
+            [('kind', '=', 'iibb'), ('tax_id', '!=', False),
+             ('company_id', 'in', invoices.mapped('company_id').ids)])
+        tax_line_obj = self.env['account.invoice.tax']
+        res = {}
+        for registry in registries:
+            tax = registry.tax_id
+            company_invoices = invoices.filtered(
+                lambda inv: inv.company_id == registry.company_id)
+            tax_line_obj.search([('invoice_id', 'in', company_invoices.ids),
+                                 ('manual', '=', True),
+                                 ('name', '=', tax.name)]).unlink()
+
+            # One lookup by registry period.
+            by_date = {}
+            for inv in company_invoices:
+                date = inv.date_invoice or fields.Date.context_today(self)
+                by_date.setdefault(date, []).append(inv)
+            for date, date_invoices in sorted(by_date.items()):
+                keys = dict((inv.id, inv._afip_registry_key())
+                            for inv in date_invoices)
+                rates = registry.get_rates(keys.values(), date)
+                for inv in date_invoices:
+                    rate = rates.get(keys[inv.id])
+                    if not rate:
+                        continue
+                    inv._afip_add_perception(tax, rate, date)
+                    res[inv.id] = rate
+        return res
+
+    @api.multi
+    def _afip_add_perception(self, tax, rate, date):
+        self.ensure_one()
+        refund = self.type == 'out_refund'
+        company_currency = self.company_id.currency_id
+        base = self.amount_untaxed
+        amount = self.currency_id.round(base * rate / 100.0)
+        to_company = self.currency_id.with_context(date=date)
+        self.env['account.invoice.tax'].create({
+            'invoice_id': self.id,
+            'name': tax.name,
+            'account_id': (refund and tax.account_paid_id or
+                           tax.account_collected_id).id,
+            'base': base,
+            'amount': amount,
+            'manual': True,
+            'sequence': tax.sequence,
+            'base_code_id': (refund and tax.ref_base_code_id or
+                             tax.base_code_id).id,
+            'tax_code_id': (refund and tax.ref_tax_code_id or
+                            tax.tax_code_id).id,
+            'base_amount': to_company.compute(base, company_currency) *
+            (refund and tax.ref_base_sign or tax.base_sign),
+            'tax_amount': to_company.compute(amount, company_currency) *
+            (refund and tax.ref_tax_sign or tax.tax_sign),
+        })
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
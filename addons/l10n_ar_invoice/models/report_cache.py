@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from openerp import api, models, tools
+
+# Change it when fragment templates change in a way not seen by their
+# write date, as when rendering helpers change.
+REPORT_FRAGMENT_VERSION = 1
+
+
+class account_invoice(models.Model):
+    """
+    Cache of invoice report fragments equal for every invoice of a company
+    and journal class.
+    """
+    _inherit = "account.invoice"
+
+    @api.model
+    @tools.ormcache(skiparg=1)
+    def _afip_render_fragment(self, template, company_id, journal_class_id,
+                              lang, stamp):
+        """
+        Render a fragment. stamp holds the version and write dates of the
+        data used, so changes to them give a new cache entry.
+        """
+        company = self.env['res.company'].browse(company_id)
+        return self.env['ir.ui.view'].with_context(lang=lang).render(
+            template, {
+                'company': company,
+                'partner': company.partner_id,
+                'journal_class': self.env['afip.journal_class'].browse(
+                    journal_class_id),
+            })
+
+    @api.multi
+    def afip_report_fragment(self, template):
+        """
+        Rendered fragment for the company and journal class of the
+        invoice.
+        """
+        self.ensure_one()
+        company = self.company_id
+        journal_class = self.journal_id.journal_class_id
+        view = self.env.ref(template)
+        stamp = (REPORT_FRAGMENT_VERSION,
+                 company.write_date,
+                 company.partner_id.write_date,
+                 company.partner_id.responsability_id.write_date,
+                 journal_class.write_date,
+                 view.write_date)
+        return self._afip_render_fragment(
+            template, company.id, journal_class.id,
+            self.env.context.get('lang'), stamp)
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
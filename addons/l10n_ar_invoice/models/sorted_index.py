@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Sorted binary files of fixed size records keyed by an unsigned integer,
+as CUIT numbers, read through mmap.
+
+A file is a header followed by records sorted by key:
+
+    magic (8 bytes), record format (8 bytes), record count (8 bytes)
+    key (unsigned 64 bits), values packed with the record format, ...
+
+Files are built with an external sort, so rows never need to fit in
+memory, and written to a temporary name renamed over the final one, so
+readers always see a whole file. Being mapped read only, the pages of a
+file are shared by every process reading it.
+"""
+import bisect
+import heapq
+import mmap
+import os
+import struct
+import tempfile
+
+MAGIC = 'AFIPIDX1'
+_header = struct.Struct('<8s8sQ')
+
+# Rows sorted in memory before being spilled to a run file.
+DEFAULT_CHUNK = 1000000
+
+
+def _record_struct(values_format):
+    if len(values_format) > 8:
+        raise ValueError('Record format too long: %s' % values_format)
+    return struct.Struct('<Q' + values_format)
+
+
+def _write_run(rows, record, directory):
+    rows.sort()
+    run = tempfile.TemporaryFile(dir=directory)
+    for row in rows:
+        run.write(record.pack(*row))
+    run.seek(0)
+    return run
+
+
+def _read_run(run, record):
+    size = record.size
+    while True:
+        data = run.read(size * 4096)
+        if not data:
+            return
+        for offset in xrange(0, len(data), size):
+            yield record.unpack_from(data, offset)
+
+
+def build_index(path, rows, values_format, chunk_size=DEFAULT_CHUNK):
+    """
+    Write rows, tuples of key and values, as an index at path. For a
+    repeated key the last value is kept. Return the number of records.
+    """
+    record = _record_struct(values_format)
+    # Position breaks ties, so the last row of a key sorts last.
+    run_record = struct.Struct('<QQ' + values_format)
+    directory = os.path.dirname(os.path.abspath(path))
+    files = []
+    chunk = []
+    for position, row in enumerate(rows):
+        chunk.append((row[0], position) + tuple(row[1:]))
+        if len(chunk) >= chunk_size:
+            files.append(_write_run(chunk, run_record, directory))
+            chunk = []
+    files.append(_write_run(chunk, run_record, directory))
+    del chunk
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    count = 0
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(_header.pack(MAGIC, values_format, 0))
+            pending = None
+            for row in heapq.merge(*[_read_run(f, run_record)
+                                     for f in files]):
+                if pending is not None and pending[0] != row[0]:
+                    out.write(record.pack(*pending))
+                    count += 1
+                pending = (row[0],) + row[2:]
+            if pending is not None:
+                out.write(record.pack(*pending))
+                count += 1
+            out.seek(0)
+            out.write(_header.pack(MAGIC, values_format, count))
+            out.flush()
+            os.fsync(out.fileno())
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    finally:
+        for f in files:
+            f.close()
+    return count
+
+
+class _Keys(object):
+    """
+    Sequence of the keys of an index, for bisect.
+    """
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.count
+
+    def __getitem__(self, i):
+        return self.index.key_struct.unpack_from(
+            self.index.data, _header.size + i * self.index.record.size)[0]
+
+
+class SortedIndex(object):
+    """
+    Read only view of an index file.
+    """
+    key_struct = struct.Struct('<Q')
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime, stat.st_size)
+            magic, values_format, self.count = _header.unpack(
+                f.read(_header.size))
+            if magic != MAGIC:
+                raise ValueError('%s is not an index file' % path)
+            self.record = _record_struct(values_format.rstrip('\0'))
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.keys = _Keys(self)
+
+    def close(self):
+        self.data.close()
+
+    def __len__(self):
+        return self.count
+
+    def _values(self, i):
+        return self.record.unpack_from(
+            self.data, _header.size + i * self.record.size)[1:]
+
+    def get(self, key, default=None):
+        """
+        Values of key.
+        """
+        i = bisect.bisect_left(self.keys, key)
+        if i < self.count and self.keys[i] == key:
+            return self._values(i)
+        return default
+
+    def get_many(self, keys):
+        """
+        Dictionary of values by key for keys found, searching each key
+        only after the previous one.
+        """
+        res = {}
+        lo = 0
+        for key in sorted(set(keys)):
+            lo = bisect.bisect_left(self.keys, key, lo)
+            if lo >= self.count:
+                break
+            if self.keys[lo] == key:
+                res[key] = self._values(lo)
+        return res
+
+    def __iter__(self):
+        """
+        Records in key order.
+        """
+        size = self.record.size
+        for offset in xrange(_header.size,
+                             _header.size + self.count * size, size):
+            yield self.record.unpack_from(self.data, offset)
+
+
+# Open indexes of this process by path.
+_open_indexes = {}
+
+
+def open_index(path):
+    """
+    Index at path, kept open between calls and reopened when the file is
+    replaced.
+    """
+    stat = os.stat(path)
+    identity = (stat.st_ino, stat.st_mtime, stat.st_size)
+    index = _open_indexes.get(path)
+    if index is None or index.identity != identity:
+        # The replaced index is left to be closed when no longer used.
+        index = _open_indexes[path] = SortedIndex(path)
+    return index
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
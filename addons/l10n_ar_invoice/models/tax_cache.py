@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+from openerp import api, models
+from collections import OrderedDict
+import copy
+import weakref
+
+# Tax computations kept by transaction.
+TAX_MEMO_SIZE = 4096
+
+
+class tax_memo(object):
+    """
+    Bounded LRU memo of tax computations, with hit and miss counters.
+    """
+
+    def __init__(self, size=TAX_MEMO_SIZE):
+        self.size = size
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        try:
+            value = self.data.pop(key)
+            self.hits += 1
+        except KeyError:
+            value = compute()
+            self.misses += 1
+            if len(self.data) >= self.size:
+                self.data.popitem(last=False)
+        self.data[key] = value
+        # Callers may change the result, never give the cached one.
+        return copy.deepcopy(value)
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.data)}
+
+_memos = weakref.WeakKeyDictionary()
+
+
+def get_tax_memo(cr):
+    """
+    Return the tax memo of the transaction running in cr. The memo is
+    dropped when the transaction is committed or rolled back.
+    """
+    if cr not in _memos:
+        _memos[cr] = tax_memo()
+        drop = lambda: _memos.pop(cr, None)
+        cr.after('commit', drop)
+        cr.after('rollback', drop)
+    return _memos[cr]
+
+
+class account_tax(models.Model):
+    _inherit = 'account.tax'
+
+    @api.multi
+    def afip_compute_all(self, price_unit, quantity, product=None,
+                         partner=None):
+        """
+        Same as compute_all, memoized by transaction on the taxes and the
+        values changing the result.
+
+        Lines of any product and partner sharing a fiscal position share
+        their results, unless a tax is computed or applied by python code,
+        which may read the product and the partner.
+        """
+        key = (tuple(self.ids),
+               tuple(self.mapped('write_date')),
+               price_unit, quantity,
+               partner and partner.property_account_position.id)
+        if self._afip_uses_code():
+            key += (product and product.id, partner and partner.id)
+        return get_tax_memo(self.env.cr).get(
+            key, lambda: self.compute_all(price_unit, quantity,
+                                          product=product, partner=partner))
+
+    @api.multi
+    def _afip_uses_code(self):
+        """
+        Whether the taxes or their children are computed or applied by
+        python code.
+        """
+        taxes = self
+        while taxes:
+            if any(tax.type == 'code' or tax.applicable_type == 'code'
+                   for tax in taxes):
+                return True
+            taxes = taxes.mapped('child_ids')
+        return False
+
+    @api.model
+    def create(self, vals):
+        get_tax_memo(self.env.cr).clear()
+        return super(account_tax, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        get_tax_memo(self.env.cr).clear()
+        return super(account_tax, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        get_tax_memo(self.env.cr).clear()
+        return super(account_tax, self).unlink()
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
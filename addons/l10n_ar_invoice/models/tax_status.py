@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+from openerp import api, models, fields, _
+from openerp.exceptions import Warning
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Partners read from the database at a time.
+_page_size = 10000
+
+
+class afip_registry(models.Model):
+    """
+    Keep partner responsabilities as published in the AFIP tax status
+    registry.
+    """
+    _inherit = 'afip.registry'
+
+    # Responsability code by VAT status, for partners not in monotributo.
+    _vat_status_codes = {
+        'AC': 'IVARI',
+        'S': 'IVARI',
+        'EX': 'IVAE',
+        'XN': 'IVAE',
+        'NA': 'IVANR',
+        'AN': 'IVANR',
+        'NI': 'CF',
+    }
+
+    @api.model
+    def _status_responsability_code(self, vat_status, category):
+        """
+        Responsability code of a registry status, or None when unknown.
+        """
+        if category and category != 'NI':
+            return 'RM'
+        return self._vat_status_codes.get(vat_status)
+
+    @api.model
+    def _partner_pages(self):
+        """
+        Yield pages of (id, CUIT, responsability id) of partners with a
+        CUIT, in CUIT order.
+        """
+        last = ('', 0)
+        while True:
+            self.env.cr.execute("""
+                SELECT id, document_number_normalized, responsability_id
+                FROM res_partner
+                WHERE document_number_normalized ~ '^[0-9]{11}$'
+                  AND (document_number_normalized, id) > (%s, %s)
+                ORDER BY document_number_normalized, id
+                LIMIT %s
+            """, last + (_page_size,))
+            rows = self.env.cr.fetchall()
+            if not rows:
+                return
+            yield rows
+            last = (rows[-1][1], rows[-1][0])
+
+    @api.multi
+    def sync_tax_status(self, path=None):
+        """
+        Set the responsability of every partner with a CUIT from the
+        current index of the registry, after loading path if given.
+        Return the number of partners changed.
+
+        The index and partners are both walked in CUIT order, so memory
+        only holds a page of partners.
+        """
+        self.ensure_one()
+        if self.kind != 'tax_status':
+            raise Warning(_('Wrong registry\n'
+                            '%s is not a tax status registry.') % self.name)
+        today = fields.Date.context_today(self)
+        if path:
+            self.load_file(path, date_from=today)
+        index = self._get_index(today)
+        if index is None:
+            raise Warning(_('No registry loaded\n'
+                            'Registry %s has no index for %s.') %
+                          (self.name, today))
+
+        resp_ids = dict((r.code, r.id) for r in
+                        self.env['afip.responsability'].search([]))
+        records = iter(index)
+        record = next(records, None)
+        count = 0
+        for page in self._partner_pages():
+            changes = []
+            for partner_id, cuit, resp_id in page:
+                key = int(cuit)
+                while record is not None and record[0] < key:
+                    record = next(records, None)
+                if record is None:
+                    break
+                if record[0] != key:
+                    continue
+                # Codes shorter than their field are padded with nulls.
+                vat_status = record[1].rstrip('\0 ')
+                category = record[2].rstrip('\0 ')
+                new_id = resp_ids.get(self._status_responsability_code(
+                    vat_status, category))
+                if new_id and new_id != resp_id:
+                    changes.append((partner_id, resp_id, new_id,
+                                    '%s/%s' % (vat_status, category)))
+            self._apply_status_changes(changes)
+            count += len(changes)
+            if record is None:
+                break
+
+        _logger.info('Registry %s changed the responsability of %i'
+                     ' partners' % (self.code, count))
+        return count
+
+    @api.multi
+    def _apply_status_changes(self, changes):
+        """
+        Write changes, tuples of partner, old and new responsability ids
+        and registry status, and log them.
+        """
+        if not changes:
+            return
+        by_resp = {}
+        for partner_id, old_id, new_id, status in changes:
+            by_resp.setdefault(new_id, []).append(partner_id)
+        partner_obj = self.env['res.partner']
+        for new_id, partner_ids in by_resp.items():
+            partner_obj.browse(partner_ids).write(
+                {'responsability_id': new_id})
+
+        now = fields.Datetime.now()
+        self.env.cr.execute("""
+            INSERT INTO afip_tax_status_change
+                (create_uid, create_date, write_uid, write_date,
+                 registry_id, partner_id, old_responsability_id,
+                 new_responsability_id, status, date)
+            SELECT %(uid)s, %(now)s, %(uid)s, %(now)s,
+                   %(registry)s, v.partner_id, v.old_id, v.new_id,
+                   v.status, %(now)s
+            FROM unnest(%(partners)s::integer[], %(olds)s::integer[],
+                        %(news)s::integer[], %(statuses)s::varchar[])
+                 AS v(partner_id, old_id, new_id, status)
+        """, {'uid': self.env.uid, 'now': now, 'registry': self.id,
+              'partners': [c[0] for c in changes],
+              'olds': [c[1] for c in changes],
+              'news': [c[2] for c in changes],
+              'statuses': [c[3] for c in changes]})
+        self.env.invalidate_all()
+
+
+class afip_tax_status_change(models.Model):
+    """
+    Responsability of a partner changed from a tax status registry.
+    """
+    _name = 'afip.tax_status_change'
+    _description = 'AFIP tax status change'
+    _order = 'date desc, id desc'
+    _rec_name = 'partner_id'
+
+    registry_id = fields.Many2one('afip.registry', 'Registry',
+                                  ondelete='set null')
+    partner_id = fields.Many2one('res.partner', 'Partner', required=True,
+                                 ondelete='cascade', select=True)
+    old_responsability_id = fields.Many2one('afip.responsability',
+                                            'Previous responsability')
+    new_responsability_id = fields.Many2one('afip.responsability',
+                                            'New responsability')
+    status = fields.Char('Registry status', size=8)
+    date = fields.Datetime('Date')
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Record query plans and timings of AFIP lookups with and without the
+module indexes.
+
+Clones existing partners, journals and invoices to build a large
+synthetic dataset, runs the module queries, and the SQL the ORM generates
+for the module searches, with EXPLAIN ANALYZE without the index pack and
+with it, and writes plans and timings as JSON. All is done in one
+transaction rolled back at the end, so the database is left as it was.
+
+    python scripts/afip_index_benchmark.py -d bench --addons-path=... \\
+        --partners 200000 --journals 2000 --invoices 1000000 -o plans.json
+"""
+import argparse
+import json
+import sys
+
+import openerp
+from openerp import api, SUPERUSER_ID
+
+# Module SQL queries, with the parameters taken from the database.
+QUERIES = [
+    ('update_new_journals', """
+        select row_number() over () as row,
+           Ri.name as Ri,
+           Dc.name as document_class,
+           JC.name as name,
+           max(JC.code) as code,
+           JC.type as type,
+           DC.id as document_class_id,
+           max(JC.id) as journal_class_id
+        from afip_responsability_relation as RC
+        left join afip_responsability as Ri
+                               on (RC.issuer_id = Ri.id)
+        left join afip_responsability as Rr
+                               on (RC.receptor_id = Rr.id)
+        left join afip_document_class as DC
+                               on (RC.document_class_id = DC.id)
+        left join afip_journal_class  as JC
+                               on (RC.document_class_id = JC.document_class_id)
+        where Ri.id = %(issuer_id)s
+          and Ri.name is not Null
+          and Dc.name is not Null
+          and JC.name is not Null
+        group by Ri.name, JC.name, JC.type, DC.name, DC.id order by name
+    """),
+    ('numbering_audit', """
+        SELECT i.id, lag(i.afip_doc_number) OVER w
+        FROM afip_invoice_history AS i
+        LEFT JOIN afip_numbering_checkpoint AS c
+            ON (c.journal_id = i.journal_id)
+        WHERE i.journal_id IN (%(journal_id)s)
+          AND i.afip_doc_number > 0
+          AND i.state NOT IN ('draft', 'cancel')
+          AND i.afip_doc_number >= COALESCE(c.last_number, 0)
+        WINDOW w AS (PARTITION BY i.journal_id
+                     ORDER BY i.afip_doc_number, i.id)
+    """),
+]
+
+# Module searches, as (name, model, domain for the parameters, order). Their
+# SQL is generated by the ORM.
+SEARCHES = [
+    ('prefered_journals', 'afip.journal_class', lambda p: [
+        ('type', 'in', ['sale']),
+        ('document_class_id.responsability_relation_ids.issuer_id', '=',
+         p['issuer_id']),
+        ('document_class_id.responsability_relation_ids.receptor_id', '=',
+         p['receptor_id']),
+    ], 'sequence asc'),
+    ('relation_index', 'afip.responsability_relation', lambda p: [], None),
+    ('partners_by_responsability', 'res.partner', lambda p: [
+        ('responsability_id', '=', p['receptor_id']),
+        ('document_type_id', '=', p['document_type_id']),
+    ], None),
+    ('journals_by_point_of_sale', 'account.journal', lambda p: [
+        ('company_id', '=', p['company_id']),
+        ('point_of_sale', '=', 1),
+        ('journal_class_id', '!=', False),
+    ], None),
+    ('export_invoices', 'account.invoice', lambda p: [
+        ('company_id', '=', p['company_id']),
+        ('afip_journal_class_code', 'in', [19, 20, 21]),
+        ('state', 'not in', ['draft', 'cancel']),
+        ('date_invoice', '>=', '2015-01-01'),
+        ('date_invoice', '<=', '2015-01-31'),
+    ], None),
+]
+
+
+def search_query(env, model, domain, order=None):
+    """
+    SQL and parameters search() runs for domain.
+    """
+    model = env[model]
+    query = model._where_calc(domain)
+    model._apply_ir_rules(query, 'read')
+    order_by = model._generate_order_by(order, query)
+    from_clause, where_clause, params = query.get_sql()
+    where_str = where_clause and (' WHERE %s' % where_clause) or ''
+    return ('SELECT "%s".id FROM %s%s%s' % (
+        model._table, from_clause, where_str, order_by), params)
+
+
+def queries(env, params):
+    res = [(name, query, params) for name, query in QUERIES]
+    for name, model, domain, order in SEARCHES:
+        query, query_params = search_query(env, model, domain(params), order)
+        res.append((name, query, query_params))
+    return res
+
+
+def columns(cr, table):
+    cr.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_name = %s AND column_name != 'id'
+        ORDER BY ordinal_position
+    """, (table,))
+    return [r[0] for r in cr.fetchall()]
+
+
+def clone(cr, table, count, overrides):
+    """
+    Insert count copies of random rows of table, replacing columns with
+    the SQL expressions in overrides; g is the copy number.
+    """
+    if count <= 0:
+        return
+    cols = columns(cr, table)
+    select = ', '.join(overrides.get(c, 't.%s' % c) for c in cols)
+    cr.execute("""
+        INSERT INTO %(table)s (%(cols)s)
+        SELECT %(select)s
+        FROM generate_series(1, %%s) AS g,
+             LATERAL (SELECT * FROM %(table)s
+                      OFFSET floor(random() * (SELECT count(*) FROM %(table)s
+                                               WHERE g > 0))
+                      LIMIT 1) AS t
+    """ % {'table': table, 'cols': ', '.join(cols), 'select': select},
+        (count,))
+
+
+def build_dataset(cr, args):
+    clone(cr, 'res_partner', args.partners, {
+        'name': "t.name || ' ' || g",
+        'document_number': "lpad((20000000000 + g)::text, 11, '0')",
+        'document_number_normalized':
+        "lpad((20000000000 + g)::text, 11, '0')",
+    })
+    clone(cr, 'account_journal', args.journals, {
+        'name': "t.name || ' ' || g",
+        'code': "substr(md5(g::text), 1, 10)",
+        'point_of_sale': "1 + mod(g, 50)",
+    })
+    clone(cr, 'account_invoice', args.invoices, {
+        'number': 'NULL',
+        'internal_number': 'NULL',
+        'move_id': 'NULL',
+        'afip_doc_number': 'g',
+        'journal_id': "(SELECT id FROM account_journal"
+                      " WHERE journal_class_id IS NOT NULL AND g > 0"
+                      " OFFSET mod(g, %i) LIMIT 1)" % max(args.journals, 1),
+        'date_invoice': "date '2010-01-01' + mod(g, 3650)",
+    })
+    for table in ('res_partner', 'account_journal', 'account_invoice',
+                  'afip_responsability_relation'):
+        cr.execute('ANALYZE %s' % table)
+
+
+def parameters(cr):
+    cr.execute("SELECT id FROM afip_responsability WHERE code = 'IVARI'")
+    issuer_id = cr.fetchone()[0]
+    cr.execute("""
+        SELECT document_class_id, receptor_id
+        FROM afip_responsability_relation WHERE issuer_id = %s LIMIT 1
+    """, (issuer_id,))
+    document_class_id, receptor_id = cr.fetchone()
+    cr.execute("SELECT id FROM afip_document_type WHERE code = 'CUIT'")
+    document_type_id = cr.fetchone()[0]
+    cr.execute("SELECT id, company_id FROM account_journal"
+               " WHERE journal_class_id IS NOT NULL LIMIT 1")
+    journal_id, company_id = cr.fetchone()
+    return {'issuer_id': issuer_id, 'issuer_code': 'IVARI',
+            'receptor_id': receptor_id,
+            'document_class_id': document_class_id,
+            'document_type_id': document_type_id,
+            'journal_id': journal_id, 'company_id': company_id}
+
+
+def explain(cr, queries, repeat):
+    res = {}
+    for name, query, params in queries:
+        runs = []
+        for i in range(repeat):
+            cr.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query,
+                       params)
+            runs.append(cr.fetchone()[0][0])
+        best = min(runs, key=lambda p: p['Execution Time'])
+        res[name] = {
+            'execution_ms': best['Execution Time'],
+            'planning_ms': best['Planning Time'],
+            'plan': best['Plan'],
+        }
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument('--addons-path')
+    parser.add_argument('--db_host')
+    parser.add_argument('--db_port')
+    parser.add_argument('--db_user')
+    parser.add_argument('--db_password')
+    parser.add_argument('--partners', type=int, default=100000)
+    parser.add_argument('--journals', type=int, default=1000)
+    parser.add_argument('--invoices', type=int, default=500000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', default='-')
+    args = parser.parse_args()
+
+    options = ['-d', args.database]
+    if args.addons_path:
+        options.append('--addons-path=%s' % args.addons_path)
+    for option in ('db_host', 'db_port', 'db_user', 'db_password'):
+        if getattr(args, option):
+            options.append('--%s=%s' % (option, getattr(args, option)))
+    openerp.tools.config.parse_config(options)
+    from openerp.addons.l10n_ar_invoice.models.indexes import \
+        ensure_indexes, drop_indexes
+
+    registry = openerp.modules.registry.RegistryManager.get(args.database)
+    cr = registry.cursor()
+    try:
+        env = api.Environment(cr, SUPERUSER_ID, {})
+        build_dataset(cr, args)
+        plan = queries(env, parameters(cr))
+
+        drop_indexes(cr)
+        cr.execute('ANALYZE')
+        before = explain(cr, plan, args.repeat)
+
+        ensure_indexes(cr)
+        cr.execute('ANALYZE')
+        after = explain(cr, plan, args.repeat)
+    finally:
+        cr.rollback()
+        cr.close()
+
+    result = {
+        'dataset': {'partners': args.partners, 'journals': args.journals,
+                    'invoices': args.invoices},
+        'queries': dict((name, {'before': before[name],
+                                'after': after[name]})
+                        for name, query, params in plan),
+    }
+    out = sys.stdout if args.output == '-' else open(args.output, 'w')
+    json.dump(result, out, indent=2)
+
+    for name, query, params in plan:
+        sys.stderr.write('%-30s %10.3f ms -> %10.3f ms\n' % (
+            name, before[name]['execution_ms'], after[name]['execution_ms']))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
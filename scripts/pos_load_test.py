@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure invoice confirmation under concurrent cashiers.
+
+Configures a company with l10n_ar_invoice.config, then runs N sessions
+creating, validating and opening invoices at the same time, on the same
+journal or on one journal by session. Reports throughput, latency
+percentiles, lock waits and deadlocks or serialization failures by
+journal, and lock waits by session.
+
+Only runs against a local PostgreSQL server: it writes invoices in the
+given database.
+
+    python scripts/pos_load_test.py -d loadtest --addons-path=... \\
+        --sessions 8 --invoices 50 --mode different
+"""
+import argparse
+import threading
+import time
+import sys
+from collections import defaultdict
+
+import psycopg2
+import openerp
+from openerp import api, SUPERUSER_ID
+
+# Server addresses accepted as local. Unix socket connections have none.
+LOCAL_ADDRESSES = (None, '127.0.0.1', '::1')
+
+# PostgreSQL error codes counted as concurrency failures.
+ERRORS = {
+    '40P01': 'deadlock',
+    '40001': 'serialization',
+    '55P03': 'lock_timeout',
+}
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+        self.lock_samples = []
+        # Journal and number of the session of each backend.
+        self.backends = {}
+        # Samples finding each session waiting for a lock.
+        self.lock_waits = defaultdict(int)
+
+    def backend(self, pid, journal, number):
+        with self.lock:
+            self.backends[pid] = (journal, number)
+
+    def ok(self, journal, seconds):
+        with self.lock:
+            self.latency[journal].append(seconds)
+
+    def error(self, journal, kind):
+        with self.lock:
+            self.errors[journal][kind] += 1
+
+
+def setup(registry, args):
+    """
+    Configure the company and return the data used by sessions.
+    """
+    with api.Environment.manage():
+        with registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            company = env['res.company'].browse(args.company_id)
+            resp = env.ref('l10n_ar_invoice.res_IVARI')
+
+            journals = env['account.journal']
+            for pos in range(args.point_of_sale,
+                             args.point_of_sale + args.points_of_sale):
+                journals |= env['account.journal'].search([
+                    ('company_id', '=', company.id),
+                    ('point_of_sale', '=', pos),
+                    ('journal_class_id.code', '=', 'FVA')])
+                if journals.filtered(lambda j: j.point_of_sale == pos):
+                    continue
+                wizard = env['l10n_ar_invoice.config'].create({
+                    'company_id': company.id,
+                    'cuit': args.cuit,
+                    'iibb': args.cuit,
+                    'start_date': '2000-01-01',
+                    'responsability_id': resp.id,
+                    'remove_old_journals': False,
+                    'point_of_sale': pos,
+                })
+                wizard.update_journals()
+                wizard.execute()
+                journals |= env['account.journal'].search([
+                    ('company_id', '=', company.id),
+                    ('point_of_sale', '=', pos),
+                    ('journal_class_id.code', '=', 'FVA')])
+
+            partner = env['res.partner'].search([
+                ('responsability_id', '=', resp.id),
+                ('customer', '=', True),
+                ('id', '!=', company.partner_id.id)], limit=1)
+            product = env['product.product'].search([
+                ('type', '=', 'consu'), ('sale_ok', '=', True)], limit=1)
+            if not (journals and partner and product):
+                sys.exit('Need FVA journals, a customer with IVA Responsable'
+                         ' Inscripto responsability and a consumable product.')
+            account = product.property_account_income or \
+                product.categ_id.property_account_income_categ
+            taxes = product.taxes_id.filtered(
+                lambda t: t.company_id == company)
+            return {
+                'company_id': company.id,
+                'journal_ids': journals.ids,
+                'partner_id': partner.id,
+                'receivable_id': partner.property_account_receivable.id,
+                'product_id': product.id,
+                'account_id': account.id,
+                'tax_ids': taxes.ids,
+            }
+
+
+def session(registry, data, journal_id, number, args, stats):
+    with api.Environment.manage():
+        cr = registry.cursor()
+        try:
+            if args.lock_timeout:
+                cr.execute("SET lock_timeout = %s", (args.lock_timeout,))
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            journal = env['account.journal'].browse(journal_id).name
+            cr.execute("SELECT pg_backend_pid()")
+            stats.backend(cr.fetchone()[0], journal, number)
+            for i in range(args.invoices):
+                start = time.time()
+                try:
+                    invoice = env['account.invoice'].create({
+                        'company_id': data['company_id'],
+                        'partner_id': data['partner_id'],
+                        'account_id': data['receivable_id'],
+                        'journal_id': journal_id,
+                        'type': 'out_invoice',
+                        'invoice_line': [(0, 0, {
+                            'name': 'Load test',
+                            'product_id': data['product_id'],
+                            'account_id': data['account_id'],
+                            'quantity': 1 + i % 5,
+                            'price_unit': 100.0,
+                            'invoice_line_tax_id': [(6, 0, data['tax_ids'])],
+                        }) for l in range(args.lines)],
+                    })
+                    invoice.button_reset_taxes()
+                    invoice.afip_validation()
+                    invoice.signal_workflow('invoice_open')
+                    cr.commit()
+                    stats.ok(journal, time.time() - start)
+                except psycopg2.Error as e:
+                    cr.rollback()
+                    env.invalidate_all()
+                    stats.error(journal, ERRORS.get(e.pgcode, 'other'))
+                except Exception:
+                    cr.rollback()
+                    env.invalidate_all()
+                    stats.error(journal, 'other')
+        finally:
+            cr.close()
+
+
+def monitor(registry, stop, stats):
+    """
+    Sample the sessions waiting for a lock, by the process id of their
+    backend, so waits of other connections to the database are not counted.
+    """
+    cr = registry.cursor()
+    try:
+        cr.autocommit(True)
+        while not stop.is_set():
+            with stats.lock:
+                backends = dict(stats.backends)
+            waiting = []
+            if backends:
+                cr.execute("SELECT DISTINCT pid FROM pg_locks "
+                           "WHERE NOT granted AND pid IN %s",
+                           (tuple(backends),))
+                waiting = [row[0] for row in cr.fetchall()]
+            with stats.lock:
+                for pid in waiting:
+                    stats.lock_waits[backends[pid]] += 1
+                stats.lock_samples.append(len(waiting))
+            time.sleep(0.1)
+    finally:
+        cr.close()
+
+
+def report(stats, elapsed):
+    sessions = defaultdict(list)
+    for journal, number in stats.backends.values():
+        sessions[journal].append(number)
+    count = len(stats.lock_samples) or 1
+
+    def waiting(journal, numbers):
+        # Percentage of the samples the sessions were waiting for a lock.
+        waits = sum(stats.lock_waits[journal, n] for n in numbers)
+        return 100.0 * waits / (count * (len(numbers) or 1))
+
+    print('%-40s %6s %8s %8s %8s %8s %6s %6s %6s %6s %6s' % (
+        'Journal', 'Ok', 'Inv/s', 'p50', 'p90', 'p99',
+        'Dlck', 'Serial', 'LckTO', 'Other', 'Wait%'))
+    journals = sorted(set(stats.latency) | set(stats.errors))
+    for journal in journals:
+        latency = stats.latency[journal]
+        errors = stats.errors[journal]
+        print('%-40s %6i %8.2f %8.3f %8.3f %8.3f %6i %6i %6i %6i %6.1f' % (
+            journal[:40], len(latency), len(latency) / elapsed,
+            percentile(latency, 50), percentile(latency, 90),
+            percentile(latency, 99), errors['deadlock'],
+            errors['serialization'], errors['lock_timeout'],
+            errors['other'], waiting(journal, sessions[journal])))
+    total = sum(len(l) for l in stats.latency.values())
+    samples = stats.lock_samples or [0]
+    print('Total: %i invoices in %.2fs, %.2f invoices/s' % (
+        total, elapsed, total / elapsed))
+    print('Waiting sessions: mean %.2f, max %i (%i samples)' % (
+        float(sum(samples)) / len(samples), max(samples), len(samples)))
+    for journal, number in sorted(stats.backends.values(),
+                                  key=lambda b: b[1]):
+        print('Session %i, %s: waiting in %.1f%% of samples' % (
+            number, journal, waiting(journal, [number])))
+
+
+def check_local(database):
+    """
+    Exit unless the server connected to, with the options, PGHOST and the
+    configuration file applied, is local.
+    """
+    cr = openerp.sql_db.db_connect(database).cursor()
+    try:
+        cr.execute("SELECT host(inet_server_addr())")
+        address = cr.fetchone()[0]
+    finally:
+        cr.close()
+    if address not in LOCAL_ADDRESSES and not address.startswith('127.'):
+        sys.exit('Load tests only run against a local PostgreSQL server,'
+                 ' connected to %s.' % address)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument('--addons-path')
+    parser.add_argument('--db_host')
+    parser.add_argument('--db_port')
+    parser.add_argument('--db_user')
+    parser.add_argument('--db_password')
+    parser.add_argument('--company-id', type=int, default=1)
+    parser.add_argument('--cuit', default='30712345671')
+    parser.add_argument('--point-of-sale', type=int, default=1)
+    parser.add_argument('--points-of-sale', type=int, default=1,
+                        help='Journals to configure and use.')
+    parser.add_argument('--sessions', type=int, default=4)
+    parser.add_argument('--invoices', type=int, default=25,
+                        help='Invoices by session.')
+    parser.add_argument('--lines', type=int, default=1,
+                        help='Lines by invoice.')
+    parser.add_argument('--mode', choices=['same', 'different'],
+                        default='same',
+                        help='All sessions in the first journal, or sessions'
+                        ' spread over the journals.')
+    parser.add_argument('--lock-timeout', default='',
+                        help='PostgreSQL lock_timeout for sessions, as 5s.')
+    args = parser.parse_args()
+
+    options = ['-d', args.database]
+    if args.addons_path:
+        options.append('--addons-path=%s' % args.addons_path)
+    for option in ('db_host', 'db_port', 'db_user', 'db_password'):
+        if getattr(args, option):
+            options.append('--%s=%s' % (option, getattr(args, option)))
+    openerp.tools.config.parse_config(options)
+    check_local(args.database)
+
+    registry = openerp.modules.registry.RegistryManager.get(args.database)
+    data = setup(registry, args)
+
+    stats = Stats()
+    stop = threading.Event()
+    watcher = threading.Thread(target=monitor, args=(registry, stop, stats))
+    watcher.start()
+
+    journals = data['journal_ids']
+    threads = []
+    for n in range(args.sessions):
+        journal_id = journals[0] if args.mode == 'same' \
+            else journals[n % len(journals)]
+        threads.append(threading.Thread(
+            target=session,
+            args=(registry, data, journal_id, n, args, stats)))
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    stop.set()
+    watcher.join()
+
+    report(stats, elapsed)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4: